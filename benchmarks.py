@@ -0,0 +1,452 @@
+"""
+Benchmarks of the hot paths of the program, with a regression check between two runs.
+• Time the hot paths of the program against the saved pages in ./fixtures
+and synthetic databases,
+so a change can be compared with the implementation it replaces.
+• Run it with: python benchmarks.py
+• The suite times save_data, fetch_data, receive_and_format_data,
+generate_boxplot and monthly_scraping over synthetic databases of 1 to 100
+stations and 50 to 180 years and a local FakeClimateServer, and writes the
+results as JSON so two commits can be compared:
+    python benchmarks.py --suite --json before.json
+    python benchmarks.py --suite --json after.json --compare before.json
+"""
+
+from datetime import date, datetime, timedelta
+from html.parser import HTMLParser
+from pathlib import Path
+import argparse
+import json
+import platform
+import random
+import sqlite3
+import subprocess
+import sys
+import tempfile
+import time
+import tracemalloc
+
+from daily_weather import DailyWeather
+from db_operations import DBOperations, DEFAULT_LOCATION, QueryCache
+from fake_climate_server import FakeClimateServer
+from http_client import HttpClient
+from plot_operations import PlotOperations
+from scrape_weather import DailyTableParser, WeatherScraper
+
+FIXTURES = Path(__file__).parent / 'fixtures'
+# top level packages weather_processor must not import before the first click
+STARTUP_DEFERRED = ('matplotlib', 'numpy', 'scrape_weather', 'db_operations', 'plot_operations',
+                    'ingest_pipeline', 'page_cache')
+
+
+class LegacyWeatherScraper(HTMLParser):
+    """
+    The per-token parser WeatherScraper used before DailyTableParser,
+    kept as the baseline of bench_parse.
+    """
+
+    def __init__(self):
+        HTMLParser.__init__(self)
+        self.recording = 0
+        self.data_list = []
+
+    def handle_starttag(self, tag, attrs):
+        if tag == 'abbr':
+            if attrs[0][1]:
+                try:
+                    date = attrs[0][1]
+                    self.data_list.append(datetime.strptime(date, '%B %d, %Y').strftime('%Y-%m-%d'))
+                except:
+                    return
+
+        if tag not in ['td']:
+            return
+
+        if self.recording:
+            self.recording += 1
+            return
+
+        if tag in ['td']:
+            self.recording = 1
+
+    def handle_endtag(self, tag):
+        if tag in ['td'] and self.recording:
+            self.recording -= 1
+
+    def handle_data(self, data):
+        if self.recording:
+            self.data_list.append(data)
+
+    @classmethod
+    def parse(cls, page: bytes) -> tuple:
+        """ same output as DailyTableParser.parse """
+        myparser = cls()
+        myparser.feed(str(page))
+
+        dates = []
+        daily_temps = {}
+        count = 0
+        current_date = ""
+        for d in myparser.data_list:
+            try:
+                datetime.strptime(d, '%Y-%m-%d')
+                current_date = d
+                dates.append(current_date)
+                daily_temps[current_date] = []
+                count = 0
+            except:
+                if d and current_date:
+                    if 'Legend' not in d and d != 'E':
+                        count += 1
+                        if count <= 3:
+                            try:
+                                daily_temps[current_date].append(float(d))
+                            except:
+                                daily_temps.pop(current_date, None)
+        rows = [(date, *temps) for date, temps in daily_temps.items()]
+        return dates, rows
+
+
+def synthetic_location(station: int) -> str:
+    """ the location of synthetic station number station, the first one is the default location """
+    return DEFAULT_LOCATION if station == 0 else f"Synthetic station {station:03d}"
+
+
+def synthetic_weather(years: int, last_year: int = 2020, seed: int = 0) -> dict:
+    """ years of random daily temperatures ending with last_year, in the WeatherScraper format """
+    rng = random.Random(seed)
+    first_day = date(last_year - years + 1, 1, 1)
+    days = (date(last_year + 1, 1, 1) - first_day).days
+    data = {}
+    for offset in range(days):
+        day = first_day + timedelta(days=offset)
+        mean = round(-20 + 22 * (1 - abs(day.month - 7) / 6) + rng.uniform(-6, 6), 1)
+        data[day.isoformat()] = {'Max': mean + 5, 'Min': mean - 5, 'Mean': mean}
+    return data
+
+
+def make_synthetic_db(db_name: str, table_name: str, years: int, last_year: int = 2020, seed: int = 0,
+                      stations: int = 1):
+    """
+    fill a database with years of random daily temperatures ending with last_year
+    for stations stations, named by synthetic_location.
+    """
+    db_operations = DBOperations(db_name, bulk_load=True)
+    db_operations.initialize_db(table_name)
+    for station in range(stations):
+        db_operations.save_data(synthetic_weather(years, last_year, seed + station), table_name,
+                                location=synthetic_location(station))
+    db_operations.close()
+
+
+def legacy_boxplot_data(db_name: str, table_name: str, start_year: int, end_year: int) -> list:
+    """
+    The per-year LIKE query path generate_boxplot used before monthly_distributions,
+    kept as the baseline of bench_boxplot.
+    """
+    monthly_weather_data = {}
+    for year in range(start_year, end_year + 1):
+        conn = sqlite3.connect(db_name)
+        cur = conn.cursor()
+        cur.execute(f"select * from {table_name} where sample_date like '{year}%';")
+        weather_data = cur.fetchall()
+        conn.close()
+        for daily_temps in weather_data:
+            month = int(daily_temps[1][5:7])
+            if month in monthly_weather_data:
+                monthly_weather_data[month] += [daily_temps[-1]]
+            else:
+                monthly_weather_data[month] = [daily_temps[-1]]
+    return [monthly_weather_data.get(month, []) for month in range(1, 13)]
+
+
+class Benchmarks():
+    """ timers of the hot paths, every bench_* method returns its measurements as a dict """
+
+    def __init__(self, repeat: int = 20):
+        self.repeat = repeat
+
+    def timeit(self, function, *args, repeat: int = None) -> float:
+        """ best wall time of repeat (default self.repeat) calls, in milliseconds """
+        best = float('inf')
+        for _ in range(repeat or self.repeat):
+            start = time.perf_counter()
+            function(*args)
+            best = min(best, time.perf_counter() - start)
+        return best * 1000
+
+    def bench_parse(self) -> dict:
+        """
+        per-page parse time of the legacy parser and DailyTableParser
+        over every fixture page, checking both give the same rows.
+        """
+        results = {}
+        for path in sorted(FIXTURES.glob('daily_data_*.html')):
+            page = path.read_bytes()
+            if LegacyWeatherScraper.parse(page) != DailyTableParser.parse(page):
+                raise AssertionError(f'parsers disagree on {path.name}')
+            results[path.name] = {'legacy_ms': self.timeit(LegacyWeatherScraper.parse, page),
+                                  'table_parser_ms': self.timeit(DailyTableParser.parse, page)}
+        return results
+
+    def bench_boxplot(self, year_counts: tuple = (10, 45, 90, 180)) -> dict:
+        """
+        time of loading the boxplot data for ranges of year_counts years,
+        legacy per-year queries against PlotOperations.monthly_distributions.
+        """
+        results = {}
+        with tempfile.TemporaryDirectory() as tmp:
+            db_name = str(Path(tmp) / 'synthetic.sqlite')
+            make_synthetic_db(db_name, 'weather', max(year_counts))
+            plot_operations = PlotOperations(db_name, 'weather')
+            for years in year_counts:
+                start_year, end_year = 2020 - years + 1, 2020
+                expected = legacy_boxplot_data(db_name, 'weather', start_year, end_year)
+                actual = plot_operations.monthly_distributions(start_year, end_year)
+                if expected != [temps.tolist() for temps in actual]:
+                    raise AssertionError(f'boxplot data differs for {years} years')
+                results[years] = {
+                    'legacy_ms': self.timeit(legacy_boxplot_data, db_name, 'weather', start_year, end_year),
+                    'single_query_ms': self.timeit(plot_operations.monthly_distributions, start_year, end_year)}
+            plot_operations.db_operations.close()
+        return results
+
+    def bench_startup(self, module: str = 'weather_processor') -> dict:
+        """
+        import time of module from python -X importtime, cold (empty bytecode cache,
+        through a fresh pycache_prefix) then warm (same cache again).
+        output {"cold": {"import_ms": ..., "modules": ..., "deferred_modules_imported": [...]},
+        "warm": {...}}, deferred_modules_imported should stay empty.
+        """
+        results = {}
+        with tempfile.TemporaryDirectory() as pycache:
+            for run in ('cold', 'warm'):
+                completed = subprocess.run(
+                    [sys.executable, '-X', 'importtime', '-X', f'pycache_prefix={pycache}', '-c', f'import {module}'],
+                    capture_output=True, text=True, cwd=Path(__file__).parent)
+                if completed.returncode:
+                    raise RuntimeError(completed.stderr.strip().splitlines()[-1])
+                imported = {}
+                for line in completed.stderr.splitlines():
+                    fields = line.replace('import time:', '').split('|')
+                    if len(fields) == 3 and fields[1].strip().isdigit():
+                        imported[fields[2].strip()] = int(fields[1])
+                results[run] = {'import_ms': imported[module] / 1000, 'modules': len(imported),
+                                'deferred_modules_imported': sorted(
+                                    {name.split('.')[0] for name in imported} & set(STARTUP_DEFERRED))}
+        return results
+
+    def check_startup(self, module: str = 'weather_processor') -> dict:
+        """ bench_startup, raising when a deferred module is imported at startup again """
+        results = self.bench_startup(module)
+        if results['warm']['deferred_modules_imported']:
+            raise AssertionError(f"{module} imports {results['warm']['deferred_modules_imported']} at startup")
+        return results
+
+    def bench_database(self, stations: int, years: int) -> dict:
+        """
+        time save_data of one station's history into a database already holding
+        stations - 1 others, then fetch_data, receive_and_format_data and generate_boxplot
+        (drawn and saved on an Agg figure, without showing it) over it, without a QueryCache,
+        and receive_and_format_data again served from a QueryCache (the *_cached_ms metrics).
+        """
+        from matplotlib.figure import Figure
+
+        results = {}
+        with tempfile.TemporaryDirectory() as tmp:
+            db_name = str(Path(tmp) / 'synthetic.sqlite')
+            make_synthetic_db(db_name, 'weather', years, stations=stations - 1, seed=1)
+            data = synthetic_weather(years)
+
+            def save_fresh_copy(run: int) -> float:
+                copy_name = str(Path(tmp) / f'save_{run}.sqlite')
+                Path(copy_name).write_bytes(Path(db_name).read_bytes())
+                db_operations = DBOperations(copy_name)
+                db_operations.initialize_db('weather')
+                start = time.perf_counter()
+                db_operations.save_data(data, 'weather', location=synthetic_location(stations - 1))
+                elapsed = time.perf_counter() - start
+                db_operations.close()
+                Path(copy_name).unlink()
+                return elapsed
+
+            results['save_data_ms'] = min(save_fresh_copy(run) for run in range(3)) * 1000
+            db_operations = DBOperations(db_name)
+            db_operations.save_data(data, 'weather', location=synthetic_location(stations - 1))
+            plot_operations = PlotOperations(db_name, 'weather', synthetic_location(stations - 1))
+            start_year = 2020 - years + 1
+
+            def generate_boxplot():
+                figure = Figure()
+                plot_operations.draw_boxplot(figure.add_subplot(), start_year, 2020)
+                figure.savefig(Path(tmp) / 'boxplot.jpg')
+
+            results['fetch_data_ms'] = self.timeit(db_operations.fetch_data, 'weather', 2000,
+                                                   synthetic_location(stations - 1))
+            results['receive_and_format_data_year_ms'] = self.timeit(plot_operations.receive_and_format_data, 2000)
+            results['receive_and_format_data_month_ms'] = self.timeit(
+                plot_operations.receive_and_format_data, 2000, 7)
+            results['generate_boxplot_ms'] = self.timeit(generate_boxplot, repeat=3)
+            cached_plot_operations = PlotOperations(db_name, 'weather', synthetic_location(stations - 1),
+                                                    cache=QueryCache())
+            results['receive_and_format_data_year_cached_ms'] = self.timeit(
+                cached_plot_operations.receive_and_format_data, 2000)
+            results['receive_and_format_data_month_cached_ms'] = self.timeit(
+                cached_plot_operations.receive_and_format_data, 2000, 7)
+            db_operations.close()
+            plot_operations.db_operations.close()
+            cached_plot_operations.db_operations.close()
+        return results
+
+    def bench_scraping(self, months: int = 12) -> dict:
+        """ time of WeatherScraper.monthly_scraping per month, against a local FakeClimateServer """
+        with FakeClimateServer(first_month=(1996, 10)) as server:
+            def scrape():
+                scraper = WeatherScraper(server.base_url)
+                for index in range(months):
+                    scraper.monthly_scraping(2019 - index // 12, 12 - index % 12)
+            return {'monthly_scraping_ms': self.timeit(scrape, repeat=3) / months}
+
+    def bench_http_faults(self, first_month: tuple = (2019, 1), max_rate: int = 10, max_workers: int = 8) -> dict:
+        """
+        the HttpClient crawling iter_monthly_batches from a FakeClimateServer that answers 429
+        above max_rate requests a second, then from one failing requests (5xx, dropped connections,
+        stalls), each compared with a clean crawl.
+        output {"throttled": {...}, "faulty": {...}}, each with the requests the server saw, the share
+        of them that failed, the pages a second and whether the weather matches the clean crawl.
+        """
+        def crawl(server_options: dict, client_options: dict) -> tuple:
+            with FakeClimateServer(first_month=first_month, **server_options) as server:
+                scraper = WeatherScraper(server.base_url, http=HttpClient(**client_options))
+                start = time.perf_counter()
+                weather = {}
+                months = 0
+                for _, _, daily_temps in scraper.iter_monthly_batches(max_workers=max_workers):
+                    weather.update(daily_temps)
+                    months += 1
+                seconds = time.perf_counter() - start
+                return weather, months, seconds, server.request_count, sum(server.fault_counts.values())
+
+        expected = crawl({}, {})[0]
+        results = {}
+        runs = {'throttled': ({'max_rate': max_rate}, {'backoff': 0.05}),
+                'faulty': ({'error_rate': 0.1, 'drop_rate': 0.05, 'stall_rate': 0.02, 'stall_seconds': 2},
+                           {'timeout': 1, 'backoff': 0.05})}
+        for name, (server_options, client_options) in runs.items():
+            weather, months, seconds, requests, faults = crawl(server_options, client_options)
+            results[name] = {'requests': requests, 'failed_share': faults / requests,
+                             'pages_per_second': months / seconds, 'data_matches': weather == expected}
+        return results
+
+    def bench_memory(self, years: int = 180, stations: int = 10) -> dict:
+        """
+        memory held by years of scraped weather for stations stations,
+        in the dict of dicts WeatherScraper used to keep, filled day by day, and in DailyWeather,
+        filled a month of parsed rows at a time as monthly_scraping does. Measured with tracemalloc, in bytes.
+        """
+        rows = [(day, temps['Max'], temps['Min'], temps['Mean'])
+                for day, temps in synthetic_weather(years).items()]
+
+        def measure(build) -> tuple:
+            tracemalloc.start()
+            start = time.perf_counter()
+            stores = [build() for _ in range(stations)]
+            seconds = time.perf_counter() - start
+            size = tracemalloc.get_traced_memory()[0]
+            tracemalloc.stop()
+            return stores, size, seconds
+
+        def build_dict():
+            weather = {}
+            for day, max_temp, min_temp, mean_temp in rows:
+                weather[str(day)] = {"Max": float(max_temp), "Min": float(min_temp), "Mean": float(mean_temp)}
+            return weather
+
+        def build_daily_weather():
+            weather = DailyWeather()
+            for start in range(0, len(rows), 30):
+                weather.add_rows(rows[start:start + 30])
+            return weather
+
+        dicts, dict_bytes, dict_seconds = measure(build_dict)
+        compact, compact_bytes, compact_seconds = measure(build_daily_weather)
+        if dict(compact[0]) != dicts[0]:
+            raise AssertionError('DailyWeather does not hold the same weather')
+        return {'days': len(rows) * stations, 'dict_bytes': dict_bytes, 'daily_weather_bytes': compact_bytes,
+                'dict_build_ms': dict_seconds * 1000, 'daily_weather_build_ms': compact_seconds * 1000}
+
+    def run_suite(self, stations: tuple = (1, 10), years: tuple = (50, 180)) -> dict:
+        """
+        run the suite for every combination of stations and years.
+        output {"meta": {...}, "results": {"save_data_ms[stations=1,years=50]": 42.1, ...}},
+        a flat mapping of metric to milliseconds that compare_results can diff.
+        """
+        results = {}
+        for station_count in stations:
+            for year_count in years:
+                for name, value in self.bench_database(station_count, year_count).items():
+                    results[f"{name}[stations={station_count},years={year_count}]"] = value
+        results.update(self.bench_scraping())
+        for name, timings in self.bench_parse().items():
+            results[f"parse_page_ms[{name}]"] = timings['table_parser_ms']
+        commit = subprocess.run(['git', 'rev-parse', '--short', 'HEAD'], capture_output=True, text=True,
+                                cwd=Path(__file__).parent).stdout.strip()
+        meta = {'commit': commit or None, 'python': platform.python_version(),
+                'platform': platform.platform(), 'time': datetime.now().isoformat(timespec='seconds')}
+        return {'meta': meta, 'results': results}
+
+
+def compare_results(old: dict, new: dict, tolerance: float = 0.2, min_ms: float = 1.0) -> list:
+    """
+    the metrics of two run_suite outputs that got slower by more than tolerance (20%)
+    and by at least min_ms, so timer noise on tiny metrics is not reported,
+    as (metric, old_ms, new_ms) tuples.
+    """
+    return [(name, old['results'][name], value) for name, value in new['results'].items()
+            if name in old['results'] and value > old['results'][name] * (1 + tolerance)
+            and value - old['results'][name] >= min_ms]
+
+
+if __name__ == "__main__":
+    PARSER = argparse.ArgumentParser(description='time the hot paths of the weather processor')
+    PARSER.add_argument('--suite', action='store_true', help='run the synthetic dataset suite')
+    PARSER.add_argument('--stations', type=int, nargs='+', default=[1, 10])
+    PARSER.add_argument('--years', type=int, nargs='+', default=[50, 180])
+    PARSER.add_argument('--json', help='write the suite results to this file')
+    PARSER.add_argument('--compare', help='suite results of an earlier run to compare with')
+    ARGS = PARSER.parse_args()
+    BENCHMARKS = Benchmarks()
+    if ARGS.suite:
+        SUITE = BENCHMARKS.run_suite(tuple(ARGS.stations), tuple(ARGS.years))
+        for NAME, VALUE in SUITE['results'].items():
+            print(f"{NAME}: {VALUE:.2f} ms")
+        if ARGS.json:
+            Path(ARGS.json).write_text(json.dumps(SUITE, indent=2))
+        if ARGS.compare:
+            REGRESSIONS = compare_results(json.loads(Path(ARGS.compare).read_text()), SUITE)
+            for NAME, OLD, NEW in REGRESSIONS:
+                print(f"REGRESSION {NAME}: {OLD:.2f} ms -> {NEW:.2f} ms")
+            sys.exit(1 if REGRESSIONS else 0)
+        sys.exit(0)
+    for name, timings in BENCHMARKS.bench_parse().items():
+        print(f"{name}: legacy {timings['legacy_ms']:.2f} ms, "
+              f"table parser {timings['table_parser_ms']:.2f} ms, "
+              f"{timings['legacy_ms'] / timings['table_parser_ms']:.1f}x")
+    for years, timings in BENCHMARKS.bench_boxplot().items():
+        print(f"boxplot data for {years} years: legacy {timings['legacy_ms']:.1f} ms, "
+              f"single query {timings['single_query_ms']:.1f} ms, "
+              f"{timings['legacy_ms'] / timings['single_query_ms']:.1f}x")
+    MEMORY = BENCHMARKS.bench_memory()
+    print(f"scraped weather of {MEMORY['days']} days: dict {MEMORY['dict_bytes'] / MEMORY['days']:.0f} bytes/day, "
+          f"DailyWeather {MEMORY['daily_weather_bytes'] / MEMORY['days']:.0f} bytes/day, "
+          f"{MEMORY['dict_bytes'] / MEMORY['daily_weather_bytes']:.1f}x")
+    for NAME, RUN in BENCHMARKS.bench_http_faults().items():
+        print(f"{NAME} crawl: {RUN['requests']} requests, {RUN['failed_share']:.0%} failed, "
+              f"{RUN['pages_per_second']:.1f} pages/s, data {'matches' if RUN['data_matches'] else 'DIFFERS'}")
+    try:
+        STARTUP = BENCHMARKS.check_startup()
+    except RuntimeError as error:
+        print('startup benchmark skipped, weather_processor does not import:', error)
+        STARTUP = {}
+    for run, timings in STARTUP.items():
+        print(f"{run} startup import: {timings['import_ms']:.1f} ms, {timings['modules']} modules")
@@ -0,0 +1,126 @@
+"""
+Day of year temperature normals and anomalies of a station.
+• Compute the day of year normals of a station over a base period
+(1991 to 2020 by default): the mean and percentiles of the daily mean
+temperature, over a window of days centred on each day of the year.
+• Compute daily and monthly anomalies, the departure of the daily mean
+temperatures from those normals, for any station and range.
+• Everything is computed with array operations over the whole history,
+no loop over the rows.
+• Normals are cached in the database and dropped by save_data only when
+it saves days of the station inside their base period.
+"""
+
+import io
+import numpy as np
+from db_operations import DBOperations
+
+# start of each month in the 366 slots of a leap year, Feb 29 has its own slot
+DAY_OF_YEAR_OFFSETS = np.cumsum([0, 31, 29, 31, 30, 31, 30, 31, 31, 30, 31, 30])
+DAYS_OF_YEAR = 366
+
+
+def day_of_year(months: np.ndarray, days: np.ndarray) -> np.ndarray:
+    """ the 0 to 365 slot of each month and day, the same slot every year """
+    return DAY_OF_YEAR_OFFSETS[np.asarray(months) - 1] + np.asarray(days) - 1
+
+
+def windowed_normals(slots: np.ndarray, values: np.ndarray, window: int, percentiles: tuple) -> np.ndarray:
+    """
+    the normals of values by day of year slot, each slot taking the values of the
+    window slots centred on it (wrapping around the year).
+    output an array of 2 + len(percentiles) rows of DAYS_OF_YEAR columns:
+    the number of values, their mean, then each percentile, NaN for a slot without values.
+    """
+    half = window // 2
+    shifts = np.arange(-half, half + 1)
+    window_slots = ((slots[None, :] + shifts[:, None]) % DAYS_OF_YEAR).ravel()
+    window_values = np.broadcast_to(values, (len(shifts), len(values))).ravel()
+    counts = np.bincount(window_slots, minlength=DAYS_OF_YEAR)
+    sums = np.bincount(window_slots, weights=window_values, minlength=DAYS_OF_YEAR)
+    filled = counts > 0
+    normals = np.full((2 + len(percentiles), DAYS_OF_YEAR), np.nan)
+    normals[0] = counts
+    normals[1, filled] = sums[filled] / counts[filled]
+
+    order = np.lexsort((window_values, window_slots))
+    sorted_values = window_values[order]
+    starts = np.concatenate(([0], np.cumsum(counts)[:-1]))
+    for row, percentile in enumerate(percentiles, start=2):
+        position = starts + (np.maximum(counts, 1) - 1) * percentile / 100
+        low = np.floor(position).astype(np.int64)
+        high = np.ceil(position).astype(np.int64)
+        fraction = position - low
+        if len(sorted_values):
+            low, high = np.minimum(low, len(sorted_values) - 1), np.minimum(high, len(sorted_values) - 1)
+            interpolated = sorted_values[low] * (1 - fraction) + sorted_values[high] * fraction
+            normals[row, filled] = interpolated[filled]
+    return normals
+
+
+class Climatology():
+    """
+    the normals of a table over a base period and the anomalies against them, normals cached through DBOperations
+    """
+
+    def __init__(self, db_operations: DBOperations, table_name: str, base: tuple = (1991, 2020),
+                 window: int = 15, percentiles: tuple = (10, 50, 90)):
+        """
+        base is the (first year, last year) period of the normals, window the number of days
+        around each day of the year they are taken over, an odd number.
+        """
+        self.db_operations = db_operations
+        self.table_name = table_name
+        self.base = base
+        self.window = window
+        self.percentiles = tuple(percentiles)
+
+    def normals(self, location: str) -> dict:
+        """
+        the normals of location, from the cache when they were computed before.
+        output {"count": array of 366, "mean": ..., "p10": ..., "p50": ..., "p90": ...},
+        indexed by day_of_year, NaN where the base period has no data.
+        """
+        key = (location, self.base[0], self.base[1], self.window, ','.join(map(str, self.percentiles)))
+        blob = self.db_operations.load_normals(self.table_name, *key)
+        if blob is None:
+            weather_data = self.db_operations.fetch_range(
+                self.table_name, f"{self.base[0]:04d}-01-01", f"{self.base[1] + 1:04d}-01-01",
+                ('month', 'day', 'avg_temp'), location)
+            normals = windowed_normals(day_of_year(weather_data['month'], weather_data['day']),
+                                       weather_data['avg_temp'], self.window, self.percentiles)
+            output = io.BytesIO()
+            np.save(output, normals)
+            self.db_operations.save_normals(self.table_name, *key, output.getvalue())
+        else:
+            normals = np.load(io.BytesIO(blob))
+        names = ['count', 'mean'] + [f"p{percentile:g}" for percentile in self.percentiles]
+        return dict(zip(names, normals))
+
+    def daily_anomalies(self, location: str, start_date: str, end_date: str) -> dict:
+        """
+        the daily mean temperatures of location with start_date <= sample_date < end_date
+        and their departure from the normal mean of their day of the year.
+        output {"sample_date": ..., "month": ..., "day": ..., "avg_temp": ..., "normal": ..., "anomaly": ...}
+        """
+        weather_data = self.db_operations.fetch_range(
+            self.table_name, start_date, end_date, ('sample_date', 'year', 'month', 'day', 'avg_temp'), location)
+        normal = self.normals(location)['mean'][day_of_year(weather_data['month'], weather_data['day'])]
+        weather_data['normal'] = normal
+        weather_data['anomaly'] = weather_data['avg_temp'] - normal
+        return weather_data
+
+    def monthly_anomalies(self, location: str, start_year: int, end_year: int) -> dict:
+        """
+        the mean daily anomaly of every month of location from start year to end year with data.
+        output {"year": array, "month": array, "anomaly": array, "count": array of days}, in date order.
+        """
+        daily = self.daily_anomalies(location, f"{start_year:04d}-01-01", f"{end_year + 1:04d}-01-01")
+        known = ~np.isnan(daily['anomaly'])
+        month_index = (daily['year'][known] - start_year) * 12 + daily['month'][known] - 1
+        months = (end_year - start_year + 1) * 12
+        counts = np.bincount(month_index, minlength=months)
+        sums = np.bincount(month_index, weights=daily['anomaly'][known], minlength=months)
+        filled = np.flatnonzero(counts)
+        return {'year': filled // 12 + start_year, 'month': filled % 12 + 1,
+                'anomaly': sums[filled] / counts[filled], 'count': counts[filled]}
@@ -0,0 +1,168 @@
+"""
+Compact day-indexed columnar store of scraped daily temperatures.
+• Hold scraped daily temperatures in float columns indexed by the day,
+about 25 bytes a day instead of the few hundred of a dict of dicts keyed
+by date strings. The columns are array.array, cheap to set one day at a
+time, and are seen as NumPy arrays without a copy for the bulk operations.
+• A missing temperature is stored as NaN and read back as None.
+• DailyWeather is a mapping with the same keys and values as the weather
+dictionary of WeatherScraper, {“2018-06-01”: {“Max”: 12.0, “Min”: 5.6, “Mean”: 7.1}},
+so DBOperations.save_data and the other callers take it unchanged.
+"""
+
+from array import array
+from collections.abc import ItemsView, MutableMapping
+from datetime import date
+import math
+import numpy as np
+
+COLUMNS = ('Max', 'Min', 'Mean')
+
+
+class DailyWeatherItems(ItemsView):
+    """ the items of a DailyWeather, iterated from the columns without a lookup per key """
+
+    def __iter__(self):
+        yield from self._mapping.iter_items()
+
+
+class DailyWeather(MutableMapping):
+    """
+    mapping of "YYYY-MM-DD" to {"Max": .., "Min": .., "Mean": ..} kept in one float column per temperature
+    """
+
+    def __init__(self, data: dict = None):
+        """
+        data is an optional mapping of "YYYY-MM-DD" to {"Max": .., "Min": .., "Mean": ..} to start with.
+        The columns cover the days from self.origin (a date ordinal) on,
+        self.present marks the days that hold a value.
+        """
+        self.origin = None
+        self.present = bytearray()
+        self.columns = {column: array('d') for column in COLUMNS}
+        self.count = 0
+        if data:
+            self.update(data)
+
+    def _reserve(self, first: int, last: int):
+        """
+        grow the columns to cover the ordinals first to last, by at least a year
+        or a quarter of their length, so growing day by day or month by month stays cheap.
+        """
+        if self.origin is None:
+            self.origin = first
+        start = self.origin
+        end = self.origin + len(self.present)
+        if start <= first and last < end:
+            return
+        step = max(366, len(self.present) // 4)
+        if first < start:
+            start = min(first, start - step)
+        if last >= end:
+            end = max(last + 1, end + step)
+        before = self.origin - start
+        after = end - self.origin - len(self.present)
+        self.present = bytearray(before) + self.present + bytearray(after)
+        for column, values in self.columns.items():
+            self.columns[column] = array('d', [math.nan]) * before + values + array('d', [math.nan]) * after
+        self.origin = start
+
+    def _arrays(self) -> tuple:
+        """ NumPy views of present and the columns, sharing their memory """
+        return (np.frombuffer(self.present, dtype=bool),
+                {column: np.frombuffer(values, dtype=np.float64) for column, values in self.columns.items()})
+
+    def _index(self, key: str) -> int:
+        """ the position of the day key in the columns, None when outside them """
+        try:
+            index = date.fromisoformat(key).toordinal() - self.origin
+        except (TypeError, ValueError):
+            return None
+        return index if 0 <= index < len(self.present) else None
+
+    def __getitem__(self, key: str) -> dict:
+        index = self._index(key) if self.count else None
+        if index is None or not self.present[index]:
+            raise KeyError(key)
+        return {column: None if math.isnan(values[index]) else values[index]
+                for column, values in self.columns.items()}
+
+    def __setitem__(self, key: str, daily_temps: dict):
+        ordinal = date.fromisoformat(key).toordinal()
+        self._reserve(ordinal, ordinal)
+        index = ordinal - self.origin
+        if not self.present[index]:
+            self.present[index] = True
+            self.count += 1
+        for column, values in self.columns.items():
+            value = daily_temps.get(column)
+            values[index] = math.nan if value is None else value
+
+    def __delitem__(self, key: str):
+        index = self._index(key) if self.count else None
+        if index is None or not self.present[index]:
+            raise KeyError(key)
+        self.present[index] = False
+        self.count -= 1
+        for values in self.columns.values():
+            values[index] = math.nan
+
+    def __contains__(self, key) -> bool:
+        index = self._index(key) if self.count else None
+        return index is not None and bool(self.present[index])
+
+    def __len__(self) -> int:
+        return self.count
+
+    def __iter__(self):
+        """ the dates in ascending order """
+        for index in np.flatnonzero(self._arrays()[0]).tolist():
+            yield date.fromordinal(self.origin + index).isoformat()
+
+    def items(self):
+        return DailyWeatherItems(self)
+
+    def iter_items(self):
+        """ (date, daily_temps) pairs in ascending date order, built from the columns """
+        present, columns = self._arrays()
+        indexes = np.flatnonzero(present)
+        values = [np.where(np.isnan(columns[c][indexes]), None, columns[c][indexes]).tolist() for c in COLUMNS]
+        for index, *temps in zip(indexes.tolist(), *values):
+            yield date.fromordinal(self.origin + index).isoformat(), dict(zip(COLUMNS, temps))
+
+    def add_rows(self, rows: list):
+        """
+        store ("2018-05-01", max, min, mean) rows as given by DailyTableParser.parse in one go,
+        a value of None is missing.
+        """
+        if not rows:
+            return
+        dates, *temps = zip(*rows)
+        ordinals = np.fromiter((date.fromisoformat(day).toordinal() for day in dates), np.int64, len(dates))
+        self._reserve(int(ordinals.min()), int(ordinals.max()))
+        indexes = ordinals - self.origin
+        present, columns = self._arrays()
+        self.count += len(np.unique(indexes[~present[indexes]]))
+        present[indexes] = True
+        for column, values in zip(COLUMNS, temps):
+            columns[column][indexes] = np.array(values, dtype=np.float64)
+
+    def to_arrays(self) -> dict:
+        """
+        the stored days as arrays, in ascending date order:
+        {"sample_date": array of datetime64[D], "Max": ..., "Min": ..., "Mean": ...}, NaN for missing values.
+        """
+        present, columns = self._arrays()
+        indexes = np.flatnonzero(present)
+        arrays = {column: values[indexes] for column, values in columns.items()}
+        arrays['sample_date'] = (indexes + self.origin - date(1970, 1, 1).toordinal()).astype('datetime64[D]') \
+            if self.origin is not None else np.zeros(0, dtype='datetime64[D]')
+        return arrays
+
+    @property
+    def nbytes(self) -> int:
+        """ the memory held by the columns """
+        return len(self.present) + sum(values.itemsize * len(values) for values in self.columns.values())
+
+    def __repr__(self) -> str:
+        return f"DailyWeather({len(self)} days)"
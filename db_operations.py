@@ -23,79 +23,750 @@ connections.
 There should be no database code anywhere else in the program.
 
 """
+from collections import OrderedDict
+from datetime import date
+from pathlib import Path
+import json
+import os
+import re
+import shutil
 import sqlite3
+import threading
 import pprint
-from scrape_weather import WeatherScraper
+import numpy as np
+from metrics import METRICS
+
+DEFAULT_LOCATION = "Winnipeg, MB"
+TABLE_COLUMNS = ('id', 'sample_date', 'location', 'min_temp', 'max_temp', 'avg_temp')
+DATE_PARTS = ('year', 'month', 'day')
+
+# quantile sketch of a month of avg_temp: a histogram of 0.5 degree bins from -60 to 50
+SKETCH_LOW = -60.0
+SKETCH_WIDTH = 0.5
+SKETCH_BINS = 220
+# the exported daily series hold one value per day from EXPORT_ORIGIN on, NaN for missing days
+EXPORT_COLUMNS = ('min_temp', 'max_temp', 'avg_temp')
+EXPORT_ORIGIN = np.datetime64('1840-01-01', 'D')
+
+
+def make_sketch(temps: np.ndarray) -> bytes:
+    """ the histogram sketch of temps, stored as a blob of uint16 counts """
+    bins = np.clip(np.floor((temps - SKETCH_LOW) / SKETCH_WIDTH).astype(np.int64), 0, SKETCH_BINS - 1)
+    return np.bincount(bins, minlength=SKETCH_BINS).astype(np.uint16).tobytes()
+
+
+def sketch_quantiles(counts: np.ndarray, quantiles: list) -> np.ndarray:
+    """
+    approximate quantiles of a histogram sketch (or the sum of several),
+    interpolating linearly inside the bin holding each quantile.
+    """
+    cumulative = np.cumsum(counts)
+    targets = np.asarray(quantiles) * cumulative[-1]
+    bins = np.minimum(np.searchsorted(cumulative, targets, side='left'), SKETCH_BINS - 1)
+    before = cumulative[bins] - counts[bins]
+    inside = np.where(counts[bins] > 0, (targets - before) / np.maximum(counts[bins], 1), 0)
+    return SKETCH_LOW + SKETCH_WIDTH * (bins + inside)
+
+
+def summarize_months(rows: list) -> list:
+    """
+    Input (location, sample_date, avg_temp) rows ordered by location and date.
+    Output one (location, year, month, count, sum, min, max, q1, median, q3, sketch)
+    tuple per location and month.
+    """
+    if not rows:
+        return []
+    locations, dates, temps = zip(*rows)
+    months = np.array(dates, dtype='datetime64[M]').astype(np.int64)
+    temps = np.array(temps, dtype=np.float64)
+    locations = np.array(locations)
+    changes = np.flatnonzero((months[1:] != months[:-1]) | (locations[1:] != locations[:-1])) + 1
+    summaries = []
+    for start, end in zip(np.r_[0, changes], np.r_[changes, len(months)]):
+        month_temps = temps[start:end]
+        q1, median, q3 = np.percentile(month_temps, [25, 50, 75])
+        summaries.append((str(locations[start]), int(months[start] // 12 + 1970), int(months[start] % 12 + 1),
+                          len(month_temps), float(month_temps.sum()), float(month_temps.min()),
+                          float(month_temps.max()), float(q1), float(median), float(q3),
+                          make_sketch(month_temps)))
+    return summaries
+
+def add_date_parts(arrays: dict):
+    """ add the year, month and day integer arrays of arrays["sample_date"] to arrays """
+    dates = arrays['sample_date']
+    months = dates.astype('datetime64[M]')
+    arrays['year'] = months.astype(np.int64) // 12 + 1970
+    arrays['month'] = months.astype(np.int64) % 12 + 1
+    arrays['day'] = (dates - months).astype(np.int64) + 1
+
+class QueryCache():
+    """ in-memory LRU of query results bounded by their bytes, invalidated by the data_version of their table """
+
+    def __init__(self, max_bytes: int = 64 * 2 ** 20):
+        """
+        keep query results in memory up to max_bytes of arrays, least recently used first out.
+        Every result is stored with the data_version of its table, a lookup at a newer
+        version drops all the results of that table.
+        table identifies the table the results come from, DBOperations uses
+        (database name, table name) so one QueryCache can be shared by several
+        DBOperations, of different databases too, and threads.
+        """
+        self.max_bytes = max_bytes
+        self.nbytes = 0
+        self._results = OrderedDict()
+        self._versions = {}
+        self._lock = threading.Lock()
+
+    def get(self, table: tuple, key: tuple, version: int) -> dict:
+        """ the result stored for key, None when there is none at this version """
+        with self._lock:
+            if self._versions.get(table) != version:
+                self._drop(table)
+                self._versions[table] = version
+            entry = self._results.get((table, key))
+            if entry is None:
+                METRICS.increment('query_cache_lookups', result='miss')
+                return None
+            self._results.move_to_end((table, key))
+        METRICS.increment('query_cache_lookups', result='hit')
+        return dict(entry[0])
+
+    def put(self, table: tuple, key: tuple, version: int, result: dict):
+        """
+        store the arrays of result for key, read only since every hit shares them.
+        A result of a version other than the current one, or bigger than max_bytes, is not kept.
+        """
+        nbytes = sum(array.nbytes for array in result.values())
+        with self._lock:
+            if self._versions.get(table) != version or nbytes > self.max_bytes:
+                return
+            for array in result.values():
+                array.flags.writeable = False
+            previous = self._results.pop((table, key), None)
+            if previous:
+                self.nbytes -= previous[1]
+            self._results[(table, key)] = (dict(result), nbytes)
+            self.nbytes += nbytes
+            while self.nbytes > self.max_bytes:
+                self.nbytes -= self._results.popitem(last=False)[1][1]
+
+    def _drop(self, table: tuple):
+        """ forget the results of table, with the lock held """
+        for cache_key in [cache_key for cache_key in self._results if cache_key[0] == table]:
+            self.nbytes -= self._results.pop(cache_key)[1]
+
+    def clear(self):
+        """ forget every result """
+        with self._lock:
+            self._results.clear()
+            self._versions.clear()
+            self.nbytes = 0
+
 
 class DBOperations():
     """docstring for DBOperations."""
 
-    def __init__(self, db_name: str):
-        """ initialize database connection """
+    def __init__(self, db_name: str, bulk_load: bool = False, timeout: float = 30, export_dir: str = None,
+                 read_only: bool = False, cache: QueryCache = None):
+        """
+        initialize database connection, one connection is kept for the life of the
+        instance and reused by every method.
+        timeout is how long a statement waits on a lock held by another connection.
+        bulk_load switches on the tune_for_bulk_load profile.
+        export_dir keeps the columnar export of the daily series there in sync with
+        save_data and purge_data, see export_series.
+        read_only opens the database for reading only, such a connection may be handed
+        from thread to thread as long as one thread uses it at a time.
+        cache keeps the results of fetch_range in memory until the data_version of their table changes.
+        """
         self.name = db_name
-        self.conn = sqlite3.connect(db_name)
+        self.export_dir = export_dir
+        self.cache = cache
+        if read_only:
+            self.conn = sqlite3.connect(f"{Path(db_name).resolve().as_uri()}?mode=ro", timeout=timeout,
+                                        uri=True, check_same_thread=False)
+        else:
+            self.conn = sqlite3.connect(db_name, timeout=timeout)
         self.cur = self.conn.cursor()
+        if bulk_load:
+            self.tune_for_bulk_load()
 
     def __enter__(self):
         return self.cur
 
     def __exit__(self, exc_type, exc_val, exc_tb):
+        """ commit the transaction, or roll it back when the block raised """
+        if exc_type:
+            self.conn.rollback()
+        else:
+            self.conn.commit()
+
+    def close(self):
         """ close db connection """
-        self.conn.commit()
         self.cur.close()
         self.conn.close()
 
+    def tune_for_bulk_load(self):
+        """
+        WAL journal so readers keep working while an ingest writes,
+        and synchronous=NORMAL so a commit does not wait for an fsync of the database.
+        A crash can lose the last commits but never corrupts the database.
+        The journal mode is stored in the database file and stays on for other connections.
+        """
+        self.cur.execute("pragma journal_mode=wal;")
+        self.cur.execute("pragma synchronous=normal;")
+
     def initialize_db(self, table_name: str):
         """
         initialize the database and create the table.
+        A day is unique per location, so one database holds many stations.
+        A table from before, where sample_date alone was unique, is migrated.
+        sample_date has an index of its own for the queries without a location.
         """
         create_table_sql =  f"""
                             create table if not exists {table_name} (
                                 id integer primary key autoincrement not null,
-                                sample_date text not null unique,
+                                sample_date text not null,
                                 location text not null,
                                 min_temp real not null,
                                 max_temp real not null,
-                                avg_temp real not null);
+                                avg_temp real not null,
+                                unique (location, sample_date));
+                            """
+        create_checkpoint_sql = """
+                            create table if not exists ingest_checkpoint (
+                                job text primary key not null,
+                                year integer not null,
+                                month integer not null,
+                                stop_date text);
+                            """
+        create_summary_sql = f"""
+                            create table if not exists {table_name}_monthly (
+                                location text not null,
+                                year integer not null,
+                                month integer not null,
+                                count integer not null,
+                                sum real not null,
+                                min real not null,
+                                max real not null,
+                                q1 real not null,
+                                median real not null,
+                                q3 real not null,
+                                sketch blob not null,
+                                primary key (location, year, month));
+                            """
+        create_sync_sql = f"""
+                            create table if not exists {table_name}_sync (
+                                location text not null,
+                                year integer not null,
+                                month integer not null,
+                                fetched_on text not null,
+                                primary key (location, year, month));
                             """
-        with DBOperations(self.name) as dbcm:
+        create_normals_sql = f"""
+                            create table if not exists {table_name}_normals (
+                                location text not null,
+                                base_start integer not null,
+                                base_end integer not null,
+                                window_days integer not null,
+                                percentiles text not null,
+                                normals blob not null,
+                                primary key (location, base_start, base_end, window_days, percentiles));
+                            """
+        create_version_sql = """
+                            create table if not exists data_version (
+                                table_name text primary key not null,
+                                version integer not null);
+                            """
+        with self as dbcm:
+            dbcm.execute("select sql from sqlite_master where type = 'table' and name = ?;", (table_name,))
+            existing = dbcm.fetchone()
+            if existing and 'unique (location, sample_date)' not in existing[0]:
+                dbcm.execute("begin;")
+                dbcm.execute(create_table_sql.replace(table_name, f"{table_name}_migrating", 1))
+                dbcm.execute(f"""insert into {table_name}_migrating
+                                 select id, sample_date, location, min_temp, max_temp, avg_temp
+                                 from {table_name};""")
+                dbcm.execute(f"drop table {table_name};")
+                dbcm.execute(f"alter table {table_name}_migrating rename to {table_name};")
             dbcm.execute(create_table_sql)
+            # range queries over all stations (no location) search by date alone
+            dbcm.execute(f"create index if not exists {table_name}_sample_date on {table_name}(sample_date);")
+            dbcm.execute(create_checkpoint_sql)
+            dbcm.execute(create_summary_sql)
+            dbcm.execute(create_sync_sql)
+            dbcm.execute(create_version_sql)
+            dbcm.execute(create_normals_sql)
+            dbcm.execute(f"select exists(select 1 from {table_name}), exists(select 1 from {table_name}_monthly);")
+            has_rows, has_summary = dbcm.fetchone()
+        if has_rows and not has_summary:
+            self.rebuild_monthly_summary(table_name)
 
-    def save_data(self, data_dict: dict, table_name: str):
+    def save_data(self, data_dict: dict, table_name: str, checkpoint: tuple = None,
+                  location: str = DEFAULT_LOCATION, fetched_months: list = None, replace: bool = False,
+                  purge_location: bool = False):
         """
-        receive a dictionary of dictionaries and correctly insert the data into the DB.
+        receive a dictionary of dictionaries and correctly insert the data of location into the DB,
+        all rows in one transaction. The monthly summaries of the months touched
+        are recomputed, the data_version of the table is bumped and the cached normals whose
+        base period holds a saved day are dropped in the same transaction.
+        checkpoint is an optional (job, year, month, stop_date) recorded in the same transaction,
+        so the checkpoint never points past data that was not committed.
+        fetched_months are the (year, month) months data_dict was downloaded for,
+        recorded as downloaded today for month_coverage.
+        replace overwrites the temperatures of the days already stored instead of keeping them.
+        purge_location first deletes everything of location, as purge_data does, in the same
+        transaction, so the old data is only gone once the new data is committed.
+        The rows inserted (or changed) and the rows ignored are counted in METRICS.
         """
-        location = "Winnipeg, MB"
         insert_sql = f"""insert or ignore into {table_name}
                    (sample_date, location, min_temp, max_temp, avg_temp)
                    values
                    (?,?,?,?,?)"""
+        if replace:
+            insert_sql = f"""insert into {table_name}
+                   (sample_date, location, min_temp, max_temp, avg_temp)
+                   values
+                   (?,?,?,?,?)
+                   on conflict (location, sample_date) do update set
+                   min_temp = excluded.min_temp, max_temp = excluded.max_temp, avg_temp = excluded.avg_temp
+                   where min_temp != excluded.min_temp or max_temp != excluded.max_temp
+                   or avg_temp != excluded.avg_temp"""
+
+        data_tuples = ((date, location, temps['Min'], temps['Max'], temps['Mean'])
+                       for date, temps in data_dict.items())
+        with METRICS.timer('db_save_seconds'), self as dbcm:
+            dbcm.execute("begin;")
+            if purge_location:
+                self._delete_rows(dbcm, table_name, location)
+            dbcm.executemany(insert_sql, data_tuples)
+            inserted = max(dbcm.rowcount, 0)
+            self._update_monthly_summary(dbcm, table_name, location, data_dict.keys())
+            version = self._bump_data_version(dbcm, table_name)
+            if data_dict:
+                dbcm.execute(f"""delete from {table_name}_normals
+                                 where location = ? and base_start <= ? and base_end >= ?;""",
+                             (location, int(max(data_dict)[:4]), int(min(data_dict)[:4])))
+            if fetched_months:
+                today = date.today().isoformat()
+                dbcm.executemany(f"insert or replace into {table_name}_sync values (?,?,?,?);",
+                                 [(location, year, month, today) for year, month in fetched_months])
+            if checkpoint:
+                dbcm.execute("insert or replace into ingest_checkpoint (job, year, month, stop_date) values (?,?,?,?)",
+                             checkpoint)
+        METRICS.increment('db_rows_inserted', inserted)
+        METRICS.increment('db_rows_ignored', len(data_dict) - inserted)
+        if self.export_dir and purge_location:
+            shutil.rmtree(self._export_path(table_name, location), ignore_errors=True)
+        if self.export_dir and data_dict:
+            self._sync_exports(table_name, version, location, min(data_dict), max(data_dict))
+        elif self.export_dir:
+            self._sync_exports(table_name, version)
+
+    def _update_monthly_summary(self, dbcm, table_name: str, location: str, dates):
+        """
+        recompute the {table_name}_monthly rows of the months of dates,
+        from one query over the daily rows of those months.
+        """
+        months = sorted({date[:7] for date in dates})
+        if not months:
+            return
+        last_year, last_month = int(months[-1][:4]), int(months[-1][5:7])
+        end_date = f"{last_year + 1:04d}-01-01" if last_month == 12 else f"{last_year:04d}-{last_month + 1:02d}-01"
+        dbcm.execute(f"""select location, sample_date, avg_temp from {table_name}
+                         where location = ? and sample_date >= ? and sample_date < ?
+                         order by sample_date;""", (location, months[0] + "-01", end_date))
+        touched = {(int(month[:4]), int(month[5:7])) for month in months}
+        summaries = [summary for summary in summarize_months(dbcm.fetchall())
+                     if (summary[1], summary[2]) in touched]
+        dbcm.executemany(f"insert or replace into {table_name}_monthly values (?,?,?,?,?,?,?,?,?,?,?);",
+                         summaries)
+
+    @staticmethod
+    def _bump_data_version(dbcm, table_name: str) -> int:
+        """ count one more change of the data of table_name, inside the caller's transaction, output the new version """
+        dbcm.execute("""insert into data_version (table_name, version) values (?, 1)
+                        on conflict (table_name) do update set version = version + 1;""", (table_name,))
+        dbcm.execute("select version from data_version where table_name = ?;", (table_name,))
+        return dbcm.fetchone()[0]
+
+    def data_version(self, table_name: str) -> int:
+        """
+        a number that grows every time save_data or purge_data changes table_name,
+        to tell whether anything derived from the table is out of date.
+        """
+        with self as dbcm:
+            try:
+                dbcm.execute("select version from data_version where table_name = ?;", (table_name,))
+            except sqlite3.OperationalError:
+                return 0
+            row = dbcm.fetchone()
+        return row[0] if row else 0
+
+    def rebuild_monthly_summary(self, table_name: str):
+        """
+        recompute every row of {table_name}_monthly from the daily rows.
+        """
+        with self as dbcm:
+            dbcm.execute("begin;")
+            dbcm.execute(f"delete from {table_name}_monthly;")
+            dbcm.execute(f"select location, sample_date, avg_temp from {table_name} order by location, sample_date;")
+            dbcm.executemany(f"insert into {table_name}_monthly values (?,?,?,?,?,?,?,?,?,?,?);",
+                             summarize_months(dbcm.fetchall()))
+
+    def fetch_monthly_summary(self, table_name: str, start_year: int, end_year: int,
+                              location: str = None) -> dict:
+        """
+        merge the monthly summaries from start year to end year by month of the year,
+        without reading the daily rows. location limits them to one station.
+        output {1: {"count": 930, "sum": -15321.4, "min": -38.1, "max": 1.2,
+                    "sketch": array of SKETCH_BINS counts, "quartiles": None}, 2: ...},
+        quartiles are the exact (q1, median, q3) when the month has a single summary row.
+        Months without data are left out.
+        """
+        with METRICS.timer('db_query_seconds', method='fetch_monthly_summary'), self as dbcm:
+            dbcm.execute(f"""select month, count, sum, min, max, q1, median, q3, sketch from {table_name}_monthly
+                             where year >= ? and year <= ?{self._location_filter(location)};""",
+                         (start_year, end_year) + self._location_args(location))
+            rows = dbcm.fetchall()
+
+        merged = {}
+        for month, count, total, low, high, q1, median, q3, sketch in rows:
+            counts = np.frombuffer(sketch, dtype=np.uint16)
+            if month not in merged:
+                merged[month] = {'count': count, 'sum': total, 'min': low, 'max': high,
+                                 'sketch': counts.astype(np.int64), 'quartiles': (q1, median, q3)}
+            else:
+                summary = merged[month]
+                summary['quartiles'] = None
+                summary['count'] += count
+                summary['sum'] += total
+                summary['min'] = min(summary['min'], low)
+                summary['max'] = max(summary['max'], high)
+                summary['sketch'] += counts
+        return merged
 
-        with DBOperations(self.name) as dbcm:
-            for date, temps in data_dict.items():
-                data_tuple = (date, location, temps['Min'] ,temps['Max'], temps['Mean'])
-                dbcm.execute(insert_sql, data_tuple)
+    def load_normals(self, table_name: str, location: str, base_start: int, base_end: int, window: int,
+                     percentiles: str) -> bytes:
+        """
+        the normals blob saved by save_normals for these parameters, None when there is none
+        or the database predates the normals table.
+        """
+        with self as dbcm:
+            try:
+                dbcm.execute(f"""select normals from {table_name}_normals where location = ? and base_start = ?
+                                 and base_end = ? and window_days = ? and percentiles = ?;""",
+                             (location, base_start, base_end, window, percentiles))
+            except sqlite3.OperationalError:
+                return None
+            row = dbcm.fetchone()
+        return row[0] if row else None
+
+    def save_normals(self, table_name: str, location: str, base_start: int, base_end: int, window: int,
+                     percentiles: str, normals: bytes):
+        """
+        cache the normals blob of location for these parameters until save_data changes their base period.
+        The cache is best effort, on a read only database or one without the normals table nothing is saved.
+        """
+        with self as dbcm:
+            try:
+                dbcm.execute(f"insert or replace into {table_name}_normals values (?,?,?,?,?,?);",
+                             (location, base_start, base_end, window, percentiles, normals))
+            except sqlite3.OperationalError:
+                return
 
-    def fetch_data(self, table_name: str, year: int) -> list:
+    def load_checkpoint(self, job: str) -> tuple:
         """
-        fetch the data base on year in the database.
+        output the (year, month, stop_date) last committed by job, None when job has no checkpoint.
         """
-        with DBOperations(self.name) as dbcm:
-            dbcm.execute(f"select * from {table_name} where sample_date like '{year}%';")
+        with self as dbcm:
+            dbcm.execute("select year, month, stop_date from ingest_checkpoint where job = ?;", (job,))
+            row = dbcm.fetchone()
+        return row
+
+    def clear_checkpoint(self, job: str):
+        """
+        forget the checkpoint of a job that completed.
+        """
+        with self as dbcm:
+            dbcm.execute("delete from ingest_checkpoint where job = ?;", (job,))
+
+    @staticmethod
+    def _location_filter(location: str, keyword: str = "and") -> str:
+        """ the where clause condition for an optional location """
+        return f" {keyword} location = ?" if location else ""
+
+    @staticmethod
+    def _location_args(location: str) -> tuple:
+        """ the query parameters for _location_filter """
+        return (location,) if location else ()
+
+    def month_coverage(self, table_name: str, location: str) -> dict:
+        """
+        the months of location known to the table, read in one query over the
+        monthly summaries and the download records.
+        output {(1996, 10): (31, "2024-05-02"), ...}, the number of days stored
+        and the date the month was last downloaded (None when it never was recorded).
+        """
+        with self as dbcm:
+            dbcm.execute(f"""select year, month, count, null from {table_name}_monthly where location = ?
+                             union all
+                             select year, month, 0, fetched_on from {table_name}_sync where location = ?;""",
+                         (location, location))
+            rows = dbcm.fetchall()
+
+        coverage = {}
+        for year, month, count, fetched_on in rows:
+            known_count, known_fetched_on = coverage.get((year, month), (0, None))
+            coverage[(year, month)] = (known_count + count, fetched_on or known_fetched_on)
+        return coverage
+
+    def latest_date(self, table_name: str, location: str = None) -> str:
+        """
+        output the most recent sample_date in the table, of location when given.
+        """
+        with self as dbcm:
+            dbcm.execute(f"select max(sample_date) from {table_name}{self._location_filter(location, 'where')};",
+                         self._location_args(location))
+            latest = dbcm.fetchall()[0][0]
+        return latest
+
+    def fetch_data(self, table_name: str, year: int, location: str = None) -> list:
+        """
+        fetch the data base on year in the database, of location when given.
+        """
+        with METRICS.timer('db_query_seconds', method='fetch_data'), self as dbcm:
+            dbcm.execute(f"select * from {table_name} where sample_date >= ? and sample_date < ?"
+                         f"{self._location_filter(location)};",
+                         (f"{year:04d}-01-01", f"{year + 1:04d}-01-01") + self._location_args(location))
             fetch_weather = dbcm.fetchall()
 
         return fetch_weather
 
+    def fetch_range(self, table_name: str, start_date: str, end_date: str,
+                    columns: tuple = ('sample_date', 'avg_temp'), location: str = None) -> dict:
+        """
+        fetch the rows with start_date <= sample_date < end_date, ordered by date,
+        of location when given (all stations otherwise),
+        as one NumPy array per column:
+            {"sample_date": array(['2020-01-01', ...], dtype='datetime64[D]'),
+             "avg_temp": array([-20.1, ...])}
+        columns are table columns, or year, month and day which are derived from
+        sample_date as integer arrays.
+        The range predicate lets SQLite search the (location, sample_date) index instead of scanning.
+        With a cache the arrays of a repeated fetch are shared and read only.
+        """
+        unknown = [c for c in columns if c not in TABLE_COLUMNS + DATE_PARTS]
+        if unknown:
+            raise ValueError(f"unknown columns {unknown}")
+        if self.cache is not None:
+            table = (self.name, table_name)
+            key = (location, start_date, end_date, tuple(columns))
+            version = self.data_version(table_name)
+            weather_data = self.cache.get(table, key, version)
+            if weather_data is None:
+                weather_data = self._fetch_range(table_name, start_date, end_date, columns, location)
+                self.cache.put(table, key, version, weather_data)
+            return weather_data
+        return self._fetch_range(table_name, start_date, end_date, columns, location)
+
+    def _fetch_range(self, table_name: str, start_date: str, end_date: str, columns: tuple, location: str) -> dict:
+        """ fetch_range from the table """
+        selected = [c for c in TABLE_COLUMNS if c in columns]
+        if 'sample_date' not in selected and any(c in DATE_PARTS for c in columns):
+            selected.insert(0, 'sample_date')
+
+        with METRICS.timer('db_query_seconds', method='fetch_range'), self as dbcm:
+            dbcm.execute(f"select {', '.join(selected)} from {table_name} "
+                         f"where sample_date >= ? and sample_date < ?{self._location_filter(location)} "
+                         "order by sample_date;",
+                         (start_date, end_date) + self._location_args(location))
+            rows = dbcm.fetchall()
+        values = dict(zip(selected, zip(*rows))) if rows else {c: () for c in selected}
+
+        arrays = {}
+        for column in selected:
+            if column == 'sample_date':
+                arrays[column] = np.array(values[column], dtype='datetime64[D]')
+            elif column == 'id':
+                arrays[column] = np.array(values[column], dtype=np.int64)
+            elif column == 'location':
+                arrays[column] = np.array(values[column], dtype=str)
+            else:
+                arrays[column] = np.array(values[column], dtype=np.float64)
+
+        if 'sample_date' in arrays:
+            add_date_parts(arrays)
+        return {c: arrays[c] for c in columns}
+
+    def purge_data(self, table_name: str, location: str = None):
+        """
+        purge the data currently in the database, only the data of location when given.
+        The monthly summaries, download records and normals of the purged data go in the same transaction,
+        which also bumps the data_version of the table.
+        """
+        with self as dbcm:
+            dbcm.execute("begin;")
+            self._delete_rows(dbcm, table_name, location)
+            version = self._bump_data_version(dbcm, table_name)
+        if self.export_dir:
+            shutil.rmtree(self._export_path(table_name, location) if location
+                          else Path(self.export_dir) / table_name, ignore_errors=True)
+            self._sync_exports(table_name, version)
+
+    def _delete_rows(self, dbcm, table_name: str, location: str):
+        """
+        delete the rows, monthly summaries, download records and normals of location
+        (of every location without one), inside the caller's transaction
+        """
+        for table in (table_name, f"{table_name}_monthly", f"{table_name}_sync", f"{table_name}_normals"):
+            dbcm.execute(f"delete from {table}{self._location_filter(location, 'where')};",
+                         self._location_args(location))
+
+    def _export_path(self, table_name: str, location: str) -> Path:
+        """ the directory of the exported series of location """
+        return Path(self.export_dir) / table_name / re.sub(r'[^0-9A-Za-z]+', '_', location).strip('_')
+
+    def export_series(self, table_name: str, location: str = None):
+        """
+        write the daily series of location (every location by default) to export_dir,
+        one .npy file per column of EXPORT_COLUMNS, indexed by the day since EXPORT_ORIGIN.
+        Once exported, save_data keeps the files up to date by rewriting only the days it saved.
+        """
+        version = self.data_version(table_name)
+        with self as dbcm:
+            dbcm.execute(f"select distinct location from {table_name}{self._location_filter(location, 'where')};",
+                         self._location_args(location))
+            locations = [row[0] for row in dbcm.fetchall()]
+        for export_location in locations:
+            shutil.rmtree(self._export_path(table_name, export_location), ignore_errors=True)
+            self._write_export(table_name, export_location, '0001-01-01', '9999-12-30', version)
+
+    @staticmethod
+    def _export_meta(path: Path) -> dict:
+        """ the meta.json of an exported series, None when there is none """
+        try:
+            return json.loads((path / "meta.json").read_text())
+        except (OSError, ValueError):
+            return None
+
+    def _sync_exports(self, table_name: str, version: int, location: str = None,
+                      first_date: str = None, last_date: str = None):
+        """
+        bring the exports of table_name to data_version version, after a change of the days of
+        location from first_date to last_date (or of no days).
+        The export of location gets the rows changed, or is rewritten whole when it was not at the
+        version before (a writer without export_dir changed the table in between, or it was never
+        exported). The other exports at the version before are marked at version, those behind
+        stay behind and fetch_series reads the table for them until export_series.
+        """
+        if location:
+            path = self._export_path(table_name, location)
+            meta = self._export_meta(path)
+            if meta is None or meta.get('data_version') != version - 1:
+                shutil.rmtree(path, ignore_errors=True)
+                first_date, last_date = '0001-01-01', '9999-12-30'
+            self._write_export(table_name, location, first_date, last_date, version)
+        for meta_path in (Path(self.export_dir) / table_name).glob('*/meta.json'):
+            meta = self._export_meta(meta_path.parent)
+            if meta and meta.get('location') != location and meta.get('data_version') == version - 1:
+                meta['data_version'] = version
+                self._write_meta(meta_path.parent, meta)
+
+    @staticmethod
+    def _write_meta(path: Path, meta: dict):
+        """ replace meta.json at once, a reader never sees it half written """
+        temporary = path / "meta.json.tmp"
+        temporary.write_text(json.dumps(meta))
+        os.replace(temporary, path / "meta.json")
+
+    def _write_export(self, table_name: str, location: str, first_date: str, last_date: str, version: int):
+        """
+        copy the rows of location from first_date to last_date into its exported series,
+        growing the files to the end of the year of the last row when they are too short,
+        then record version as the data_version the series is at.
+        A grown file is written aside and renamed over the old one, readers keep their mapping.
+        """
+        end_date = str(np.datetime64(last_date, 'D') + 1)
+        series = self.fetch_range(table_name, first_date, end_date, ('sample_date',) + EXPORT_COLUMNS, location)
+        path = self._export_path(table_name, location)
+        if not len(series['sample_date']):
+            if (path / "meta.json").exists():
+                self._write_meta(path, {**self._export_meta(path), 'data_version': version})
+            return
+        days = (series['sample_date'] - EXPORT_ORIGIN).astype(np.int64)
+        year_end = (series['sample_date'][-1].astype('datetime64[Y]') + 1).astype('datetime64[D]')
+        length = int((year_end - EXPORT_ORIGIN).astype(np.int64))
+        path.mkdir(parents=True, exist_ok=True)
+        with METRICS.timer('export_seconds'):
+            for column in EXPORT_COLUMNS:
+                column_path = path / f"{column}.npy"
+                array = np.load(column_path, mmap_mode='r+') if column_path.exists() else None
+                if array is None or len(array) < length:
+                    grown_path = path / f"{column}.growing.npy"
+                    grown = np.lib.format.open_memmap(grown_path, mode='w+', dtype=np.float64, shape=(length,))
+                    grown[:] = np.nan
+                    if array is not None:
+                        grown[:len(array)] = array
+                    del array
+                    grown.flush()
+                    os.replace(grown_path, column_path)
+                    array = grown
+                array[days] = series[column]
+                array.flush()
+                del array
+            self._write_meta(path, {'location': location, 'origin': str(EXPORT_ORIGIN), 'data_version': version})
+
+    def load_series(self, table_name: str, location: str) -> dict:
+        """
+        map the exported daily series of location read only, nothing is read until used.
+        output {"sample_date": array of datetime64[D], "min_temp": memmap, "max_temp": memmap,
+                "avg_temp": memmap}, one value per day from EXPORT_ORIGIN, NaN for missing days,
+        or None when location was never exported.
+        """
+        path = self._export_path(table_name, location)
+        if not (path / "meta.json").exists():
+            return None
+        series = {column: np.load(path / f"{column}.npy", mmap_mode='r') for column in EXPORT_COLUMNS}
+        # a file being grown by a writer can be a year longer than the others for a moment
+        length = min(len(array) for array in series.values())
+        series = {column: array[:length] for column, array in series.items()}
+        series['sample_date'] = EXPORT_ORIGIN + np.arange(length)
+        return series
 
-    def purge_data(self, table_name: str):
+    def fetch_series(self, table_name: str, start_date: str, end_date: str,
+                     columns: tuple = ('sample_date', 'avg_temp'), location: str = DEFAULT_LOCATION) -> dict:
         """
-        purge the data currently in the database.
+        fetch_range of one location read from its exported series instead of the table,
+        the days without data are left out. columns are sample_date, EXPORT_COLUMNS
+        and the date parts. output None when location was never exported, or when its export
+        is not at the data_version of the table (changed by a writer without export_dir, or
+        being brought up to date right now), for the caller to read the table instead.
+        Only the days of the range are read from the files, but leaving out the days without
+        data copies them into new arrays; load_series gives the NaN padded series without a copy.
         """
-        with DBOperations(self.name) as dbcm:
-            dbcm.execute(f"delete from {table_name} ;")
+        version = self.data_version(table_name)
+        path = self._export_path(table_name, location)
+        meta = self._export_meta(path)
+        if meta is None or meta.get('data_version') != version:
+            return None
+        series = self.load_series(table_name, location)
+        if series is None:
+            return None
+        unknown = [c for c in columns if c not in ('sample_date',) + EXPORT_COLUMNS + DATE_PARTS]
+        if unknown:
+            raise ValueError(f"unknown columns {unknown}")
+        with METRICS.timer('db_query_seconds', method='fetch_series'):
+            first, last = (np.clip((np.datetime64(day, 'D') - EXPORT_ORIGIN).astype(np.int64),
+                                   0, len(series['sample_date'])) for day in (start_date, end_date))
+            present = ~np.isnan(series['avg_temp'][first:last])
+            arrays = {column: series[column][first:last][present] for column in series}
+            add_date_parts(arrays)
+        return {c: arrays[c] for c in columns}
 
 
 if __name__ == "__main__":
+    from scrape_weather import WeatherScraper
     WEATHER = WeatherScraper()
     WEATHER.start_scraping()
     weather_data_from_weather_scraper = WEATHER.weather
@@ -106,3 +777,4 @@ if __name__ == "__main__":
     DB_OPERATIONS.purge_data(TABLE_NAME)
     DB_OPERATIONS.save_data(weather_data_from_weather_scraper, TABLE_NAME)
     pprint.pprint(DB_OPERATIONS.fetch_data(TABLE_NAME, 1996))
+    DB_OPERATIONS.close()
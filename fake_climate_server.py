@@ -0,0 +1,236 @@
+"""
+Local stand-in for the Environment Canada daily data pages, with fault injection.
+• Serve daily data pages in the same layout as the Environment Canada
+climate website, so the WeatherScraper can be exercised locally without
+touching the real site.
+• Like the real site, a request for a month outside the available history
+returns the page of the closest available month instead of an error.
+• Temperatures are generated from a seed, so every run serves the same pages.
+• Connections are kept alive and pages are gzipped when the client asks for it.
+• Faults can be injected to exercise the retries and the rate limiting of
+the scraper: error responses, dropped connections and stalls at given
+rates, and a 429 with Retry-After above a given request rate.
+"""
+
+import calendar
+import gzip
+import random
+import threading
+import time
+from datetime import date
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+from urllib.parse import urlparse, parse_qs
+
+
+class FakeClimateServer():
+    """ serves generated daily data pages on a background thread, counting requests and injected faults """
+
+    def __init__(self, first_month: tuple = (1996, 10), last_month: tuple = None,
+                 host: str = '127.0.0.1', port: int = 0, seed: int = 27174,
+                 latency: float = 0.0, error_rate: float = 0.0, drop_rate: float = 0.0,
+                 stall_rate: float = 0.0, stall_seconds: float = 5.0, max_rate: float = None):
+        """
+        first_month and last_month are (year, month) tuples of the available history,
+        last_month defaults to the current month.
+        latency is the number of seconds every response is delayed, to mimic the real site.
+        error_rate is the share of requests answered with a 500 or 503, drop_rate the share
+        whose connection is closed without a response, stall_rate the share held for
+        stall_seconds before the response. Above max_rate requests a second (over the last
+        second) requests are answered with a 429 and Retry-After: 1.
+        """
+        today = date.today()
+        self.first_month = first_month
+        self.last_month = last_month or (today.year, today.month)
+        self.seed = seed
+        self.latency = latency
+        self.error_rate = error_rate
+        self.drop_rate = drop_rate
+        self.stall_rate = stall_rate
+        self.stall_seconds = stall_seconds
+        self.max_rate = max_rate
+        self.request_count = 0
+        self.connection_count = 0
+        self.fault_counts = {'error': 0, 'drop': 0, 'stall': 0, 'throttle': 0}
+        self._fault_random = random.Random(seed)
+        self._recent = []
+        self._lock = threading.Lock()
+        self.httpd = ThreadingHTTPServer((host, port), self._make_handler())
+        self.httpd.daemon_threads = True
+        self._thread = None
+
+    @property
+    def base_url(self) -> str:
+        """ the url to hand to WeatherScraper(base_url=...) """
+        host, port = self.httpd.server_address[:2]
+        return f"http://{host}:{port}/climate_data/daily_data_e.html"
+
+    def __enter__(self):
+        self.start()
+        return self
+
+    def __exit__(self, exc_type, exc_val, exc_tb):
+        self.stop()
+
+    def start(self):
+        """ serve requests on a background thread """
+        self._thread = threading.Thread(target=self.httpd.serve_forever, daemon=True)
+        self._thread.start()
+
+    def stop(self):
+        """ shut the server down """
+        self.httpd.shutdown()
+        self.httpd.server_close()
+
+    def clamp(self, year: int, month: int) -> tuple:
+        """ return the month the real site would serve for year and month """
+        wanted = year * 12 + month - 1
+        first = self.first_month[0] * 12 + self.first_month[1] - 1
+        last = self.last_month[0] * 12 + self.last_month[1] - 1
+        served = min(max(wanted, first), last)
+        return served // 12, served % 12 + 1
+
+    def daily_rows(self, station_id: int, year: int, month: int) -> list:
+        """
+        output a list of (day, max, min, mean) for the month,
+        a value of None is rendered as a missing cell.
+        """
+        rng = random.Random(f"{self.seed}-{station_id}-{year}-{month}")
+        last_day = calendar.monthrange(year, month)[1]
+        if (year, month) == self.last_month and (year, month) == (date.today().year, date.today().month):
+            last_day = date.today().day
+        rows = []
+        for day in range(1, last_day + 1):
+            mean = round(-20 + 22 * (1 - abs(month - 7) / 6) + rng.uniform(-6, 6), 1)
+            spread = rng.uniform(2, 8)
+            max_temp = round(mean + spread, 1)
+            min_temp = round(mean - spread, 1)
+            if rng.random() < 0.02:
+                max_temp = None
+            rows.append((day, max_temp, min_temp, mean))
+        return rows
+
+    def render_page(self, station_id: int, year: int, month: int) -> str:
+        """ render the daily data page for station, year and month as html """
+        year, month = self.clamp(year, month)
+        month_name = calendar.month_name[month]
+        cells = []
+        for day, max_temp, min_temp, mean in self.daily_rows(station_id, year, month):
+            row = [f'<tr><th scope="row"><abbr title="{month_name} {day}, {year}">{day:02d}</abbr></th>']
+            for value in (max_temp, min_temp, mean):
+                if value is None:
+                    row.append('<td><span class="wb-inv">Legend</span>M</td>')
+                elif day % 9 == 0:
+                    row.append(f'<td>{value}<abbr title="Estimated">E</abbr></td>')
+                else:
+                    row.append(f'<td>{value}</td>')
+            row.append('<td>&nbsp;</td><td>0.0</td><td>18.0</td><td>0.0</td><td>0.0</td><td>0.0</td><td>T</td>')
+            row.append('</tr>')
+            cells.append(''.join(row))
+        return ('<!DOCTYPE html><html lang="en"><head><meta charset="utf-8">'
+                f'<title>Daily Data Report for {month_name} {year} - Climate</title></head><body>'
+                '<nav><abbr title="Environment and Climate Change Canada">ECCC</abbr><ul>'
+                + ''.join(f'<li><a href="/services/topic-{i}.html" title="Topic {i}">Topic {i} services '
+                          f'and information</a></li>' for i in range(400))
+                + '</ul></nav>'
+                '<form><select id="Year">'
+                + ''.join(f'<option value="{y}">{y}</option>' for y in range(self.first_month[0], self.last_month[0] + 1))
+                + '</select></form>'
+                '<div class="table-responsive"><table class="data-table table-striped table-condensed">'
+                f'<caption>Daily Data Report for {month_name} {year}</caption>'
+                '<thead><tr><th>DAY</th><th>Max Temp °C</th><th>Min Temp °C</th><th>Mean Temp °C</th>'
+                '<th>Heat Deg Days °C</th><th>Cool Deg Days °C</th><th>Total Rain mm</th>'
+                '<th>Total Snow cm</th><th>Total Precip mm</th><th>Snow on Grnd cm</th></tr></thead><tbody>'
+                + ''.join(cells)
+                + '<tr><th scope="row">Sum</th><td>&nbsp;</td><td>&nbsp;</td><td>&nbsp;</td><td>0.0</td></tr>'
+                '<tr><th scope="row">Avg</th><td>1.0</td><td>-1.0</td><td>0.0</td><td>&nbsp;</td></tr>'
+                '<tr><th scope="row">Xtrm</th><td>9.9</td><td>-9.9</td><td>&nbsp;</td><td>&nbsp;</td></tr>'
+                '</tbody></table></div>'
+                '<dl><dt><abbr title="Legend">Legend</abbr></dt><dd>E = Estimated</dd><dd>M = Missing</dd></dl>'
+                '<footer><ul>'
+                + ''.join(f'<li><a href="/corporate/page-{i}.html">Corporate page {i}</a></li>' for i in range(200))
+                + '</ul></footer></body></html>')
+
+    def pick_fault(self) -> str:
+        """ count a request and draw the fault it gets: None, 'throttle', 'error', 'drop' or 'stall' """
+        with self._lock:
+            self.request_count += 1
+            fault = None
+            if self.max_rate:
+                now = time.monotonic()
+                self._recent = [t for t in self._recent if t > now - 1] + [now]
+                if len(self._recent) > self.max_rate:
+                    fault = 'throttle'
+            if not fault:
+                draw = self._fault_random.random()
+                for name, rate in (('error', self.error_rate), ('drop', self.drop_rate),
+                                   ('stall', self.stall_rate)):
+                    if draw < rate:
+                        fault = name
+                        break
+                    draw -= rate
+            if fault:
+                self.fault_counts[fault] += 1
+            return fault
+
+    def _make_handler(self):
+        server = self
+
+        class Handler(BaseHTTPRequestHandler):
+            protocol_version = 'HTTP/1.1'
+
+            def setup(self):
+                super().setup()
+                with server._lock:
+                    server.connection_count += 1
+
+            def do_GET(self):
+                query = parse_qs(urlparse(self.path).query)
+                try:
+                    station_id = int(query['StationID'][0])
+                    year = int(query['Year'][0])
+                    month = int(query['Month'][0])
+                except (KeyError, ValueError):
+                    self.send_error(400)
+                    return
+                fault = server.pick_fault()
+                if fault == 'drop':
+                    self.close_connection = True
+                    return
+                if fault == 'throttle':
+                    self.send_response(429)
+                    self.send_header('Retry-After', '1')
+                    self.send_header('Content-Length', '0')
+                    self.end_headers()
+                    return
+                if fault == 'error':
+                    self.send_error(503 if server.fault_counts['error'] % 2 else 500)
+                    return
+                if fault == 'stall':
+                    time.sleep(server.stall_seconds)
+                if server.latency:
+                    time.sleep(server.latency)
+                body = server.render_page(station_id, year, month).encode('utf-8')
+                self.send_response(200)
+                self.send_header('Content-Type', 'text/html; charset=utf-8')
+                if 'gzip' in self.headers.get('Accept-Encoding', ''):
+                    body = gzip.compress(body, compresslevel=1)
+                    self.send_header('Content-Encoding', 'gzip')
+                self.send_header('Content-Length', str(len(body)))
+                self.end_headers()
+                try:
+                    self.wfile.write(body)
+                except (BrokenPipeError, ConnectionResetError):
+                    # the client gave up on a stalled response
+                    self.close_connection = True
+
+
+            def log_message(self, format, *args):
+                return
+
+        return Handler
+
+
+if __name__ == "__main__":
+    with FakeClimateServer() as SERVER:
+        print('serving on', SERVER.base_url)
+        input("press enter to finish")
@@ -0,0 +1,192 @@
+"""
+HTTP client of the scraper: pooled keep-alive connections, retries and adaptive rate limiting.
+• Keep persistent keep-alive connections to each host and reuse them
+across requests and threads, instead of a new connection per page.
+• Ask for gzip and decompress it.
+• Every request has a timeout, and a failed connection, a timeout, a 429
+or a 5xx response is retried after a jittered exponential backoff,
+honouring Retry-After.
+• An AdaptiveRateLimiter paces the requests: it halves its rate when the
+server pushes back (429, 5xx, timeouts) and raises it step by step while
+the responses are healthy, so a long crawl runs as fast as the server
+allows without hammering it.
+"""
+
+from http.client import HTTPConnection, HTTPSConnection, HTTPException
+from urllib.parse import urljoin, urlsplit
+import gzip
+import io
+import random
+import threading
+import time
+import urllib.error
+from metrics import METRICS
+
+RETRY_STATUSES = {429, 500, 502, 503, 504}
+REDIRECT_STATUSES = {301, 302, 303, 307, 308}
+
+
+class AdaptiveRateLimiter():
+    """ paces requests across threads with additive increase, multiplicative decrease of the request rate """
+
+    def __init__(self, rate: float = 8.0, min_rate: float = 0.25, max_rate: float = 32.0,
+                 increase: float = 1.0, cooldown: float = 1.0):
+        """
+        rate is the starting number of requests a second, kept between min_rate and max_rate.
+        Healthy responses raise the rate by increase a second, however many there are,
+        a push back halves it, at most once every cooldown seconds since the requests
+        in flight get pushed back together.
+        """
+        self.rate = rate
+        self.min_rate = min_rate
+        self.max_rate = max_rate
+        self.increase = increase
+        self.cooldown = cooldown
+        self._last_back_off = float('-inf')
+        self._next_slot = self._last_change = time.monotonic()
+        self._lock = threading.Lock()
+
+    def acquire(self):
+        """ wait for the next request slot """
+        with self._lock:
+            now = time.monotonic()
+            slot = max(self._next_slot, now)
+            self._next_slot = slot + 1 / self.rate
+        if slot > now:
+            time.sleep(slot - now)
+
+    def success(self):
+        """ a healthy response, ramp the rate up by increase for each second since the last change """
+        with self._lock:
+            now = time.monotonic()
+            elapsed = min(now - self._last_change, self.cooldown)
+            self._last_change = now
+            self.rate = min(self.max_rate, self.rate + self.increase * elapsed)
+
+    def back_off(self, retry_after: float = None):
+        """ the server pushed back, halve the rate and hold every request for retry_after seconds """
+        with self._lock:
+            now = time.monotonic()
+            if now - self._last_back_off >= self.cooldown:
+                self.rate = max(self.min_rate, self.rate / 2)
+                self._last_back_off = self._last_change = now
+            if retry_after:
+                self._next_slot = max(self._next_slot, now + retry_after)
+
+
+class HttpClient():
+    """
+    GET requests over pooled keep-alive connections, retried with backoff and paced by an AdaptiveRateLimiter
+    """
+
+    def __init__(self, timeout: float = 30, retries: int = 4, backoff: float = 0.5,
+                 max_backoff: float = 30, rate_limiter: AdaptiveRateLimiter = None):
+        """
+        timeout is the connect and read timeout of every request, in seconds.
+        A request is tried up to 1 + retries times, waiting a random time of up to
+        backoff * 2 ** attempt seconds (at most max_backoff) before each retry.
+        """
+        self.timeout = timeout
+        self.retries = retries
+        self.backoff = backoff
+        self.max_backoff = max_backoff
+        self.rate_limiter = rate_limiter or AdaptiveRateLimiter()
+        self._idle = {}
+        self._lock = threading.Lock()
+
+    def _connection(self, scheme: str, netloc: str) -> tuple:
+        """ an idle connection to netloc, or a new one. output (connection, reused) """
+        with self._lock:
+            idle = self._idle.get((scheme, netloc))
+            if idle:
+                return idle.pop(), True
+        METRICS.increment('http_connections_opened')
+        connection_class = HTTPSConnection if scheme == 'https' else HTTPConnection
+        return connection_class(netloc, timeout=self.timeout), False
+
+    def _release(self, scheme: str, netloc: str, connection):
+        """ keep a connection whose response was read completely for the next request """
+        with self._lock:
+            self._idle.setdefault((scheme, netloc), []).append(connection)
+
+    def close(self):
+        """ close every idle connection """
+        with self._lock:
+            idle, self._idle = self._idle, {}
+        for connections in idle.values():
+            for connection in connections:
+                connection.close()
+
+    def _request(self, url: str, headers: dict) -> tuple:
+        """
+        one request on a pooled connection, output (status, reason, headers, body).
+        A reused connection the server closed in the meantime is replaced once, without a retry.
+        """
+        parts = urlsplit(url)
+        target = (parts.path or '/') + ('?' + parts.query if parts.query else '')
+        headers = {'Accept-Encoding': 'gzip', **(headers or {})}
+        while True:
+            connection, reused = self._connection(parts.scheme, parts.netloc)
+            try:
+                connection.request('GET', target, headers=headers)
+                response = connection.getresponse()
+                body = response.read()
+            except (ConnectionError, HTTPException) as error:
+                connection.close()
+                if reused:
+                    continue
+                raise error
+            except OSError:
+                connection.close()
+                raise
+            if response.will_close:
+                connection.close()
+            else:
+                self._release(parts.scheme, parts.netloc, connection)
+            if response.headers.get('Content-Encoding') == 'gzip':
+                body = gzip.decompress(body)
+            return response.status, response.reason, response.headers, body
+
+    def get(self, url: str, headers: dict = None) -> tuple:
+        """
+        GET url, following redirects and retrying what can be retried.
+        output (body, headers) of a 2xx response, raise urllib.error.HTTPError for
+        any other status (a 304 included) once the retries are used up,
+        and the last connection error or timeout when no response came at all.
+        """
+        redirects = 0
+        attempt = 0
+        while True:
+            self.rate_limiter.acquire()
+            started = time.perf_counter()
+            status = 'error'
+            retry_after = None
+            try:
+                code, reason, response_headers, body = self._request(url, headers)
+                status = str(code)
+            except (OSError, HTTPException) as error:
+                if attempt >= self.retries:
+                    raise
+                METRICS.increment('http_retries', reason=type(error).__name__)
+                self.rate_limiter.back_off()
+            else:
+                if code in REDIRECT_STATUSES and response_headers.get('Location') and redirects < 5:
+                    url = urljoin(url, response_headers['Location'])
+                    redirects += 1
+                    continue
+                if code not in RETRY_STATUSES:
+                    self.rate_limiter.success()
+                    METRICS.increment('http_response_bytes', len(body))
+                    if 200 <= code < 300:
+                        return body, response_headers
+                    raise urllib.error.HTTPError(url, code, reason, response_headers, io.BytesIO(body))
+                if attempt >= self.retries:
+                    raise urllib.error.HTTPError(url, code, reason, response_headers, io.BytesIO(body))
+                METRICS.increment('http_retries', reason=status)
+                retry_after = response_headers.get('Retry-After')
+                retry_after = float(retry_after) if retry_after and retry_after.isdigit() else None
+                self.rate_limiter.back_off(retry_after)
+            finally:
+                METRICS.observe('http_request_seconds', time.perf_counter() - started, status=status)
+            time.sleep(random.uniform(0, min(self.max_backoff, self.backoff * 2 ** attempt)))
+            attempt += 1
@@ -0,0 +1,253 @@
+"""
+Stream scraped months into the database in chunks, with checkpoints, cancelling and incremental updates.
+• Stream the monthly batches of the WeatherScraper straight into the
+database through DBOperations, instead of collecting the whole history in
+memory and saving it at the end.
+• Batches are written in chunks of chunk_months months, each chunk in one
+transaction together with a checkpoint of the oldest month it contains.
+• An interrupted install resumes from the month before its checkpoint
+instead of starting over.
+• ingest_stations runs the pipelines of many stations at once.
+• An update downloads only the months missing from the database or
+still open to revision, planned from the month coverage of the station.
+• A run can report its progress to a callback and be cancelled from another
+thread, it then stops at the next month boundary after committing the
+months it has, and resumes from there next time.
+"""
+
+import calendar
+from concurrent.futures import ThreadPoolExecutor
+from datetime import date, datetime, timedelta
+import time
+from db_operations import DBOperations
+from http_client import HttpClient
+from metrics import METRICS
+from scrape_weather import WeatherScraper, STATIONS, BASE_URL
+
+
+class IngestPipeline():
+    """
+    installs or updates the weather data of one station, scraping and writing month chunk by month chunk
+    """
+
+    def __init__(self, db_name: str, table_name: str, scraper: WeatherScraper = None,
+                 job: str = None, chunk_months: int = 12, location: str = None, max_workers: int = 4,
+                 progress=None, cancel_event=None, settle_days: int = 10, export_dir: str = None):
+        """
+        location is the name the rows of the scraper's station are stored under,
+        from STATIONS by default. max_workers is the number of months downloaded at once.
+        progress is called after every month with (months_done, months_total, rows_written,
+        eta_seconds), months_total and eta_seconds are None until they can be estimated.
+        cancel_event is a threading.Event, setting it stops the run at the next month.
+        settle_days is how long after its end a month may still be revised by the site.
+        export_dir keeps a columnar export of the station's daily series there, see DBOperations.
+        """
+        self.db_name = db_name
+        self.table_name = table_name
+        self.scraper = scraper or WeatherScraper()
+        self.job = job or f"ingest-{self.scraper.station_id}"
+        self.chunk_months = chunk_months
+        self.location = location or STATIONS.get(self.scraper.station_id, str(self.scraper.station_id))
+        self.max_workers = max_workers
+        self.progress = progress
+        self.cancel_event = cancel_event
+        self.settle_days = settle_days
+        self.cancelled = False
+        self.db_operations = DBOperations(db_name, bulk_load=True, export_dir=export_dir)
+
+    def _run(self, start: tuple = None, date_for_stop: str = None, purge: bool = False) -> int:
+        """
+        scrape from start back to date_for_stop (or the beginning of the history)
+        and write the monthly batches chunk by chunk, output the number of months written.
+        purge replaces the station's rows, see _write.
+        """
+        months_total = self._months_total(start, date_for_stop) if self.progress else None
+        batches = self.scraper.iter_monthly_batches(start, date_for_stop, self.max_workers)
+        return self._write(batches, months_total, checkpoint=True, date_for_stop=date_for_stop, purge=purge)
+
+    def _write(self, batches, months_total: int = None, checkpoint: bool = False,
+               date_for_stop: str = None, replace: bool = False, record_fetched: bool = True,
+               purge: bool = False) -> int:
+        """
+        write the (year, month, daily_temps) batches chunk by chunk, reporting progress
+        and stopping at a cancel, output the number of months written.
+        With checkpoint, every chunk records the oldest month it holds for _resume.
+        replace overwrites the days already stored with the values scraped.
+        record_fetched records the months as downloaded today, see DBOperations.save_data.
+        purge deletes the station's rows in the transaction of the first chunk, a run that
+        fails before its first chunk is written leaves the old rows in place.
+        """
+        started = time.monotonic()
+        chunk = {}
+        chunk_months = []
+        months = 0
+        rows_written = 0
+        for year, month, daily_temps in batches:
+            chunk.update(daily_temps)
+            chunk_months.append((year, month))
+            months += 1
+            self.cancelled = bool(self.cancel_event and self.cancel_event.is_set())
+            if len(chunk_months) == self.chunk_months or self.cancelled:
+                self.db_operations.save_data(chunk, self.table_name,
+                                             (self.job, year, month, date_for_stop) if checkpoint else None,
+                                             self.location, chunk_months if record_fetched else None, replace,
+                                             purge)
+                purge = False
+                rows_written += len(chunk)
+                chunk = {}
+                chunk_months = []
+            if self.progress:
+                eta_seconds = None
+                if months_total:
+                    eta_seconds = (time.monotonic() - started) / months * max(months_total - months, 0)
+                self.progress(months, months_total, rows_written, eta_seconds)
+            if self.cancelled:
+                batches.close()
+                return months
+        if chunk_months:
+            self.db_operations.save_data(chunk, self.table_name,
+                                         (self.job, year, month, date_for_stop) if checkpoint else None,
+                                         self.location, chunk_months if record_fetched else None, replace,
+                                         purge)
+            rows_written += len(chunk)
+        if self.progress:
+            self.progress(months, months_total, rows_written, 0.0)
+        if checkpoint:
+            self.db_operations.clear_checkpoint(self.job)
+        return months
+
+    def plan_sync(self, today: date = None) -> list:
+        """
+        the (year, month) months an update has to download, newest first, from the
+        month coverage of the station read in one query:
+        • every month since the oldest stored one that was never downloaded and
+        has missing days (a hole, or a month stored before downloads were recorded),
+        • every month downloaded before it settled, that is less than settle_days
+        after its end, since the site may still revise it. The current month is always included.
+        A station without rows is planned from the beginning of the history.
+        """
+        today = today or date.today()
+        coverage = self.db_operations.month_coverage(self.table_name, self.location)
+        if coverage:
+            first_year, first_month = min(coverage)
+        else:
+            first_year, first_month = self.scraper.find_earliest_month()
+
+        plan = []
+        for index in range(today.year * 12 + today.month - 1, first_year * 12 + first_month - 2, -1):
+            year, month = index // 12, index % 12 + 1
+            days = calendar.monthrange(year, month)[1]
+            settled_on = date(year, month, days) + timedelta(days=self.settle_days)
+            count, fetched_on = coverage.get((year, month), (0, None))
+            if fetched_on:
+                stale = date.fromisoformat(fetched_on) < settled_on
+            else:
+                stale = count < days or today < settled_on
+            if stale:
+                plan.append((year, month))
+        return plan
+
+    def sync(self) -> int:
+        """
+        download the months of plan_sync, max_workers at once, and overwrite the station's
+        rows of those months with them. output the number of months written.
+        The planned months are stale by definition, their cached pages are revalidated with
+        the site, and in offline mode they are written without being recorded as downloaded.
+        """
+        plan = self.plan_sync()
+        batches = self.scraper.iter_months(plan, self.max_workers, revalidate=True)
+        offline = bool(self.scraper.cache and self.scraper.cache.offline)
+        return self._write(batches, len(plan), replace=True, record_fetched=not offline)
+
+    def _months_total(self, start: tuple = None, date_for_stop: str = None) -> int:
+        """
+        the number of months a run from start back to date_for_stop will scrape,
+        without date_for_stop the history boundary is searched for (a few requests).
+        """
+        today = datetime.today()
+        first = start[0] * 12 + start[1] - 1 if start else today.year * 12 + today.month - 1
+        if date_for_stop:
+            stop_date = datetime.strptime(date_for_stop, '%Y-%m-%d')
+            last_year, last_month = stop_date.year, stop_date.month
+        else:
+            last_year, last_month = self.scraper.find_earliest_month()
+        return max(first - (last_year * 12 + last_month - 1) + 1, 0)
+
+    def _resume(self) -> int:
+        """
+        carry on from the checkpoint of an interrupted run,
+        output the number of months written or None when there is no checkpoint.
+        """
+        checkpoint = self.db_operations.load_checkpoint(self.job)
+        if not checkpoint:
+            return None
+        year, month, date_for_stop = checkpoint
+        month -= 1
+        if month == 0:
+            month = 12
+            year -= 1
+        return self._run((year, month), date_for_stop)
+
+    def install(self, resume: bool = True) -> int:
+        """
+        replace the station's rows with all its weather data, purged with the first chunk written,
+        or with resume and a checkpoint left by an interrupted run, carry on from that checkpoint.
+        output the number of months written.
+        """
+        with METRICS.timer('ingest_seconds', mode='install'):
+            self.db_operations.initialize_db(self.table_name)
+            months = self._resume() if resume else None
+            if months is not None:
+                return months
+            return self._run(purge=True)
+
+    def update(self) -> int:
+        """
+        download the months plan_sync finds missing or stale, a routine update
+        costs one or two requests. An interrupted install is resumed first.
+        output the number of months written.
+        """
+        with METRICS.timer('ingest_seconds', mode='update'):
+            self.db_operations.initialize_db(self.table_name)
+            months = self._resume()
+            if months is not None:
+                return months
+            return self.sync()
+
+
+def ingest_stations(db_name: str, table_name: str, stations: dict, update: bool = False,
+                    max_parallel_stations: int = 4, workers_per_station: int = 4,
+                    base_url: str = BASE_URL, cache=None) -> dict:
+    """
+    install (or with update, update) many stations into one database at once.
+    stations is {station_id: location}. Up to max_parallel_stations stations are
+    scraped at the same time, each downloading at most workers_per_station months
+    at once, so the site sees at most their product of requests in flight.
+    Every station has its own pipeline and connection, their chunk transactions
+    take turns on the database lock. The scrapers share one HttpClient, so one
+    pool of keep-alive connections and one rate limit for the site.
+    output {station_id: months written}.
+    """
+    db_operations = DBOperations(db_name)
+    db_operations.initialize_db(table_name)
+    db_operations.close()
+    http = HttpClient()
+
+    def ingest(station_id):
+        pipeline = IngestPipeline(db_name, table_name, WeatherScraper(base_url, cache, station_id, http),
+                                  location=stations[station_id], max_workers=workers_per_station)
+        try:
+            return pipeline.update() if update else pipeline.install()
+        finally:
+            pipeline.db_operations.close()
+
+    with ThreadPoolExecutor(max_workers=max_parallel_stations) as executor:
+        return dict(zip(stations, executor.map(ingest, stations)))
+
+
+if __name__ == "__main__":
+    PIPELINE = IngestPipeline('weather.sqlite', 'weather')
+    METRICS.enable_profiling()
+    print(PIPELINE.install(), 'months installed')
+    print(METRICS.profile_report('ingest_seconds'))
+    METRICS.dump_jsonl('metrics.jsonl')
@@ -0,0 +1,157 @@
+"""
+In-process counters, timings and optional cProfile profiles of the program stages.
+• Collect counters and timings from the scraper, database and plotting
+layers in process, e.g. HTTP latency and bytes per request, parse time per
+page, rows inserted or ignored per save_data, query time per fetch and
+render / save time per plot.
+• Read them with METRICS.snapshot(), or dump them as JSON lines or in the
+Prometheus text format.
+• METRICS.enable_profiling() runs the timed stages of the calling thread
+under cProfile, and METRICS.profile_report(stage) shows where that stage
+spends its time.
+"""
+
+from contextlib import contextmanager
+import cProfile
+import io
+import json
+import pstats
+import threading
+import time
+
+
+class Metrics():
+    """ thread safe counters and timings keyed by name and labels, METRICS is the instance of the process """
+
+    def __init__(self):
+        self._lock = threading.Lock()
+        self._counters = {}
+        self._timings = {}
+        self._profiles = {}
+        self._profiling_thread = None
+        self._local = threading.local()
+
+    @staticmethod
+    def _key(name: str, labels: dict) -> tuple:
+        return name, tuple(sorted(labels.items()))
+
+    def increment(self, name: str, value: float = 1, **labels):
+        """ add value to the counter name """
+        key = self._key(name, labels)
+        with self._lock:
+            self._counters[key] = self._counters.get(key, 0) + value
+
+    def observe(self, name: str, seconds: float, **labels):
+        """ record one timing of name, kept as count, sum, min and max """
+        key = self._key(name, labels)
+        with self._lock:
+            timing = self._timings.get(key)
+            if timing is None:
+                self._timings[key] = {'count': 1, 'sum': seconds, 'min': seconds, 'max': seconds}
+            else:
+                timing['count'] += 1
+                timing['sum'] += seconds
+                timing['min'] = min(timing['min'], seconds)
+                timing['max'] = max(timing['max'], seconds)
+
+    @contextmanager
+    def timer(self, name: str, **labels):
+        """
+        time the with block as name, in seconds.
+        With profiling on, the outermost timed block of the profiled thread also runs under cProfile.
+        Only one profiler can be active in a process (Python 3.12 raises ValueError for a second),
+        so the other threads are timed only, and a block is timed only when another tool is profiling.
+        """
+        profiler = None
+        if self._profiling_thread == threading.get_ident() and not getattr(self._local, 'profiling', False):
+            profiler = cProfile.Profile()
+            try:
+                profiler.enable()
+                self._local.profiling = True
+            except ValueError:
+                profiler = None
+        start = time.perf_counter()
+        try:
+            yield
+        finally:
+            self.observe(name, time.perf_counter() - start, **labels)
+            if profiler:
+                profiler.disable()
+                self._local.profiling = False
+                with self._lock:
+                    if name in self._profiles:
+                        self._profiles[name].add(profiler)
+                    else:
+                        self._profiles[name] = pstats.Stats(profiler)
+
+    def enable_profiling(self, enabled: bool = True):
+        """ switch the cProfile hook of timer on or off, for the calling thread """
+        self._profiling_thread = threading.get_ident() if enabled else None
+
+    def profile_report(self, stage: str, limit: int = 20, sort: str = 'cumulative') -> str:
+        """ the top limit functions of the profiled stage, as printed by pstats """
+        with self._lock:
+            stats = self._profiles.get(stage)
+            if stats is None:
+                return f"no profile for {stage}"
+            output = io.StringIO()
+            stats.stream = output
+            stats.sort_stats(sort).print_stats(limit)
+        return output.getvalue()
+
+    def snapshot(self) -> dict:
+        """
+        output {"counters": [{"name": ..., "labels": {...}, "value": ...}],
+                "timings": [{"name": ..., "labels": {...}, "count": ..., "sum": ..., "min": ..., "max": ...}]}
+        """
+        with self._lock:
+            return {'counters': [{'name': name, 'labels': dict(labels), 'value': value}
+                                 for (name, labels), value in sorted(self._counters.items())],
+                    'timings': [{'name': name, 'labels': dict(labels), **timing}
+                                for (name, labels), timing in sorted(self._timings.items())]}
+
+    def reset(self):
+        """ forget every counter, timing and profile """
+        with self._lock:
+            self._counters.clear()
+            self._timings.clear()
+            self._profiles.clear()
+
+    def dump_jsonl(self, path: str):
+        """ append the snapshot to path, one JSON object per metric and line """
+        snapshot = self.snapshot()
+        now = time.time()
+        with open(path, 'a') as jsonl:
+            for kind in ('counters', 'timings'):
+                for metric in snapshot[kind]:
+                    jsonl.write(json.dumps({'time': now, 'kind': kind[:-1], **metric}) + '\n')
+
+    def to_prometheus(self, prefix: str = 'weather_') -> str:
+        """ the snapshot in the Prometheus text exposition format """
+        def labels_text(labels):
+            if not labels:
+                return ''
+            pairs = ','.join(f'{label}="{str(value)}"' for label, value in sorted(labels.items()))
+            return '{' + pairs + '}'
+
+        snapshot = self.snapshot()
+        lines = []
+        declared = set()
+        for metric in snapshot['counters']:
+            name = prefix + metric['name']
+            if name not in declared:
+                lines.append(f"# TYPE {name} counter")
+                declared.add(name)
+            lines.append(f"{name}{labels_text(metric['labels'])} {metric['value']}")
+        for metric in snapshot['timings']:
+            name = prefix + metric['name']
+            if name not in declared:
+                lines.append(f"# TYPE {name} summary")
+                declared.add(name)
+            lines.append(f"{name}_count{labels_text(metric['labels'])} {metric['count']}")
+            lines.append(f"{name}_sum{labels_text(metric['labels'])} {metric['sum']}")
+        return '\n'.join(lines) + '\n'
+
+
+# the process wide instance every module reports to
+METRICS = Metrics()
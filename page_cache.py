@@ -0,0 +1,144 @@
+"""
+On-disk cache of the downloaded monthly daily data pages.
+• Keep the monthly daily data pages downloaded by the WeatherScraper on disk,
+keyed by station, year and month, so rebuilding the database after a purge
+only reads local files.
+• A month that is over (older than last month) never changes on the site, so
+a page downloaded after its month was over is kept forever. The current and
+previous month are still being revised, their pages (and a page downloaded
+back then, even once its month is over) are fresh for ttl seconds and then
+revalidated with the ETag / Last-Modified the site sent.
+• The cache is bounded to max_bytes, the least recently used pages are
+evicted first.
+• In offline mode only the cache is read, whatever its age, and the network
+is never touched; a page that is not cached raises PageNotCached.
+"""
+
+import json
+import os
+import threading
+import time
+from datetime import date
+from pathlib import Path
+
+
+class PageNotCached(LookupError):
+    """ a page asked for in offline mode is not in the cache """
+
+
+class PageCache():
+    """
+    the cached pages of every station under cache_dir, one .html file and one .json of metadata per month
+    """
+
+    def __init__(self, cache_dir: str = './page_cache', max_bytes: int = 256 * 1024 * 1024,
+                 ttl: float = 3600, offline: bool = False):
+        self.cache_dir = Path(cache_dir)
+        self.max_bytes = max_bytes
+        self.ttl = ttl
+        self.offline = offline
+        self._size = None
+        self._lock = threading.Lock()
+
+    def _paths(self, station_id: int, year: int, month: int) -> tuple:
+        """ the page file and its metadata file """
+        page = self.cache_dir / str(station_id) / f"{year:04d}-{month:02d}.html"
+        return page, page.with_suffix('.json')
+
+    @staticmethod
+    def is_closed(year: int, month: int, today: date = None) -> bool:
+        """ True when year and month is older than the previous month """
+        today = today or date.today()
+        return (year * 12 + month) < (today.year * 12 + today.month - 1)
+
+    @staticmethod
+    def settle_time(year: int, month: int) -> float:
+        """ the timestamp from which year and month is closed, the first of the month after next """
+        index = year * 12 + month + 1
+        return time.mktime((index // 12, index % 12 + 1, 1, 0, 0, 0, 0, 0, -1))
+
+    def load(self, station_id: int, year: int, month: int) -> tuple:
+        """
+        output (body, meta) of the cached page or None,
+        meta = {"fetched_at": 1607385600.0, "settles_at": 1609459200.0, "etag": ..., "last_modified": ...}
+        """
+        page, meta_path = self._paths(station_id, year, month)
+        try:
+            body = page.read_bytes()
+            meta = json.loads(meta_path.read_text())
+            os.utime(page)
+        except (OSError, ValueError):
+            return None
+        return body, meta
+
+    def is_fresh(self, meta: dict, year: int, month: int) -> bool:
+        """
+        a page downloaded after its month closed is always fresh, the others for ttl seconds,
+        so a page cached while its month was still revised is revalidated once more.
+        """
+        if self.offline:
+            return True
+        fetched_at = meta.get('fetched_at', 0)
+        if self.is_closed(year, month) and fetched_at >= meta.get('settles_at', self.settle_time(year, month)):
+            return True
+        return time.time() - fetched_at < self.ttl
+
+    @staticmethod
+    def validators(meta: dict) -> dict:
+        """ conditional request headers for revalidating a cached page """
+        headers = {}
+        if meta.get('etag'):
+            headers['If-None-Match'] = meta['etag']
+        if meta.get('last_modified'):
+            headers['If-Modified-Since'] = meta['last_modified']
+        return headers
+
+    def store(self, station_id: int, year: int, month: int, body: bytes, headers=None):
+        """ save a downloaded page, headers are the response headers """
+        page, meta_path = self._paths(station_id, year, month)
+        page.parent.mkdir(parents=True, exist_ok=True)
+        meta = {'fetched_at': time.time(),
+                'settles_at': self.settle_time(year, month),
+                'etag': headers.get('ETag') if headers else None,
+                'last_modified': headers.get('Last-Modified') if headers else None}
+        with self._lock:
+            size = self._current_size()
+            old_size = page.stat().st_size if page.exists() else 0
+            tmp_page = page.with_suffix(f'.{threading.get_ident()}.tmp')
+            tmp_page.write_bytes(body)
+            os.replace(tmp_page, page)
+            meta_path.write_text(json.dumps(meta))
+            self._size = size + len(body) - old_size
+            self._evict()
+
+    def refresh(self, station_id: int, year: int, month: int):
+        """ mark a cached page as just revalidated (the site answered 304) """
+        page, meta_path = self._paths(station_id, year, month)
+        with self._lock:
+            meta = json.loads(meta_path.read_text())
+            meta['fetched_at'] = time.time()
+            meta_path.write_text(json.dumps(meta))
+
+    def _current_size(self) -> int:
+        if self._size is None:
+            self._size = sum(p.stat().st_size for p in self.cache_dir.glob('*/*.html'))
+        return self._size
+
+    def _evict(self):
+        """ delete least recently used pages until the cache fits in max_bytes """
+        if self._size <= self.max_bytes:
+            return
+        pages = sorted(self.cache_dir.glob('*/*.html'), key=lambda p: p.stat().st_mtime)
+        for page in pages:
+            if self._size <= self.max_bytes:
+                break
+            self._size -= page.stat().st_size
+            page.unlink()
+            page.with_suffix('.json').unlink(missing_ok=True)
+
+    def clear(self):
+        """ remove every cached page """
+        with self._lock:
+            for path in self.cache_dir.glob('*/*'):
+                path.unlink()
+            self._size = 0
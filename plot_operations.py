@@ -12,19 +12,65 @@ and the y axis being temperature.
 There should be no plotting code anywhere else in the program.
 """
 
-from db_operations import DBOperations
-from scrape_weather import WeatherScraper
-import pprint
-from datetime import date
+from climatology import Climatology, day_of_year
+from db_operations import DBOperations, DEFAULT_LOCATION, QueryCache, SKETCH_LOW, SKETCH_WIDTH, sketch_quantiles
 from pathlib import Path
-import matplotlib.pyplot as plt
+import calendar
+from contextlib import nullcontext
+from concurrent.futures import ProcessPoolExecutor
+from itertools import repeat
+import io
+import time
+import numpy as np
+from metrics import METRICS
+
+# matplotlib is imported where it is used, importing this module stays cheap
+
+
+def plot_file_stem(spec: tuple) -> str:
+    """
+    the file name, without extension, of the plot spec, the same from generate_* and render_batch:
+    boxplot_from2000to2020, lineplot_2020-1, anomaly_2020 for a whole year, anomaly_2020-1
+    """
+    kind, first, second = spec
+    if kind == 'boxplot':
+        return f'boxplot_from{first}to{second}'
+    if kind == 'anomaly' and not second:
+        return f'anomaly_{first}'
+    return f'{kind}_{first}-{second}'
+
 
 class PlotOperations():
     """docstring for PlotOperations."""
 
-    def __init__(self, db: str, table: str):
+    def __init__(self, db: str, table: str, location: str = DEFAULT_LOCATION, export_dir: str = None,
+                 read_only: bool = False, cache: QueryCache = None):
+        """
+        location is the station whose data is plotted.
+        export_dir reads the daily series from the columnar export there when the station has one.
+        read_only opens the database read only, see DBOperations.
+        cache is an optional QueryCache keeping the queried data in memory for the next plots,
+        so plotting the same year or month again does not query SQLite until the data changes.
+        """
         self.db_name = db
         self.table_name = table
+        self.location = location
+        self.export_dir = export_dir
+        self.db_operations = DBOperations(db, export_dir=export_dir, read_only=read_only, cache=cache)
+        self.climatology = Climatology(self.db_operations, table)
+
+    def fetch_range(self, start_date: str, end_date: str, columns: tuple) -> dict:
+        """
+        the fetch_range columns of the station, memory mapped from the export when there is one
+        """
+        weather_data = None
+        if self.export_dir:
+            weather_data = self.db_operations.fetch_series(self.table_name, start_date, end_date, columns,
+                                                           self.location)
+        if weather_data is None:
+            weather_data = self.db_operations.fetch_range(self.table_name, start_date, end_date, columns,
+                                                          self.location)
+        return weather_data
 
     def receive_and_format_data(self, year: int, specific_month: int = 0) -> dict:
         """
@@ -37,83 +83,269 @@ class PlotOperations():
             weather_data = {1: 1.1, 2: 8.1}
             The dictionary key is the day
         """
-        db_operations = DBOperations(self.db_name)
-        weather_data = db_operations.fetch_data(self.table_name, year)
-
-        mean_temps_for_plot = {}
         if not specific_month:
-            for daily_temps in weather_data:
-                month = daily_temps[1][5:7]
-                mean_temp = daily_temps[-1]
-
-                if int(month) in mean_temps_for_plot:
-                    mean_temps_for_plot[int(month)].append(mean_temp)
-                else:
-                    mean_temps_for_plot[int(month)] = [mean_temp]
+            weather_data = self.fetch_range(f"{year:04d}-01-01", f"{year + 1:04d}-01-01", ('month', 'avg_temp'))
+            months = weather_data['month']
+            mean_temps = weather_data['avg_temp']
+            mean_temps_for_plot = {int(month): mean_temps[months == month].tolist()
+                                   for month in np.unique(months)}
         else:
-            for daily_temps in weather_data:
-                month = daily_temps[1][5:7]
-                day = daily_temps[1][-2:]
-                mean_temp = daily_temps[-1]
-
-                if int(month) == specific_month:
-                    mean_temps_for_plot[int(day)] = mean_temp
+            next_year, next_month = (year + 1, 1) if specific_month == 12 else (year, specific_month + 1)
+            weather_data = self.fetch_range(f"{year:04d}-{specific_month:02d}-01",
+                                            f"{next_year:04d}-{next_month:02d}-01", ('day', 'avg_temp'))
+            mean_temps_for_plot = dict(zip(weather_data['day'].tolist(), weather_data['avg_temp'].tolist()))
         return mean_temps_for_plot
 
-    def generate_boxplot(self, start_year: int, end_year: int):
+    def monthly_distributions(self, start_year: int, end_year: int) -> list:
+        """
+        daily mean temperatures from start year to end year grouped by month,
+        read with one query.
+        output a list of 12 arrays, January first, each in date order,
+        a month without data is an empty array.
+        """
+        weather_data = self.fetch_range(f"{start_year:04d}-01-01", f"{end_year + 1:04d}-01-01", ('month', 'avg_temp'))
+        months = weather_data['month']
+        order = np.argsort(months, kind='stable')
+        boundaries = np.searchsorted(months[order], np.arange(2, 13))
+        return np.split(weather_data['avg_temp'][order], boundaries)
+
+    def summary_boxplot_stats(self, start_year: int, end_year: int) -> list:
+        """
+        boxplot statistics from start year to end year from the monthly summary table,
+        in the format of matplotlib's Axes.bxp, one dict per month with data.
+        Over several years the quartiles and whiskers (1.5 IQR) come from the merged
+        histogram sketches, so they are accurate to about one 0.5 degree bin;
+        min, max and mean are always exact.
+        """
+        summaries = self.db_operations.fetch_monthly_summary(self.table_name, start_year, end_year, self.location)
+        stats = []
+        for month in sorted(summaries):
+            summary = summaries[month]
+            counts = summary['sketch']
+            q1, median, q3 = summary['quartiles'] or sketch_quantiles(counts, [0.25, 0.5, 0.75])
+            low_limit = q1 - 1.5 * (q3 - q1)
+            high_limit = q3 + 1.5 * (q3 - q1)
+            edges = SKETCH_LOW + SKETCH_WIDTH * np.arange(len(counts) + 1)
+            filled = np.flatnonzero(counts)
+            low_bin = filled[edges[filled + 1] > low_limit][0]
+            high_bin = filled[edges[filled] < high_limit][-1]
+            stats.append({'label': month, 'med': median, 'q1': q1, 'q3': q3,
+                          'whislo': max(edges[low_bin], low_limit, summary['min']),
+                          'whishi': min(edges[high_bin + 1], high_limit, summary['max']),
+                          'mean': summary['sum'] / summary['count'], 'fliers': []})
+        return stats
+
+    def plot_data(self, spec: tuple, from_summary: bool = False):
+        """
+        query the data the plot of spec draws, spec and from_summary as in draw,
+        so it can be fetched ahead and drawn later with draw(..., data=...)
+        """
+        kind, first, second = spec
+        if kind == 'boxplot':
+            if from_summary:
+                return self.summary_boxplot_stats(first, second)
+            return self.monthly_distributions(first, second)
+        if kind in ('lineplot', 'normal_lineplot'):
+            return (self.receive_and_format_data(first, second),
+                    self.climatology.normals(self.location) if kind == 'normal_lineplot' else None)
+        if kind == 'anomaly':
+            if second:
+                next_year, next_month = (first + 1, 1) if second == 12 else (first, second + 1)
+                start_date, end_date = f"{first:04d}-{second:02d}-01", f"{next_year:04d}-{next_month:02d}-01"
+            else:
+                start_date, end_date = f"{first:04d}-01-01", f"{first + 1:04d}-01-01"
+            return self.climatology.daily_anomalies(self.location, start_date, end_date)
+        raise ValueError(f"unknown plot {kind}")
+
+    def draw_boxplot(self, axes, start_year: int, end_year: int, from_summary: bool = False, data=None):
+        """
+        draw the monthly boxplot from start year to end year on axes.
+        from_summary draws it from the monthly summary table instead of the daily rows,
+        which takes the same time whatever the length of the range (outliers are not drawn).
+        data is what plot_data gives for the plot, queried here when None.
+        """
+        with METRICS.timer('plot_render_seconds', kind='boxplot'):
+            if data is None:
+                data = self.plot_data(('boxplot', start_year, end_year), from_summary)
+            if from_summary:
+                axes.bxp(data, positions=[month_stats['label'] for month_stats in data], showfliers=False)
+            else:
+                axes.boxplot(data)
+            axes.set_xlabel('Month')
+            axes.set_ylabel('Temperature (Celsius)')
+            axes.set_title('Monthly Temperature Distribution for:' + str(start_year) + ' to ' + str(end_year))
+            axes.set_xlim(0, 13)
+
+    def draw_lineplot(self, axes, year: int, month: int, normal_band: bool = False, data=None):
+        """
+        draw the daily mean temperatures of year and month on axes.
+        normal_band draws the normal mean and the 10th to 90th percentile band of
+        each day behind them, from the cached normals of self.climatology.
+        data is what plot_data gives for the plot, queried here when None.
+        """
+        with METRICS.timer('plot_render_seconds', kind='lineplot'):
+            if data is None:
+                data = self.plot_data(('normal_lineplot' if normal_band else 'lineplot', year, month))
+            weather_data_month, normals = data
+            if normal_band:
+                days = np.arange(1, calendar.monthrange(year, month)[1] + 1)
+                slots = day_of_year(np.full(len(days), month), days)
+                axes.fill_between(days, normals['p10'][slots], normals['p90'][slots], color='lightgrey',
+                                  label='10th to 90th percentile')
+                axes.plot(days, normals['mean'][slots], color='grey', linestyle='--', label='Normal')
+            axes.plot(list(weather_data_month.keys()), list(weather_data_month.values()), label=str(year))
+            if normal_band:
+                axes.legend()
+            axes.set_xlabel('Day')
+            axes.set_ylabel('Temperature (Celsius)')
+            axes.set_title('Daily Temperature Distribution for:' + str(year) + '/' + str(month))
+
+    def draw_anomaly_plot(self, axes, year: int, month: int = 0, data=None):
+        """
+        draw the daily anomalies of year and month (the whole year when month is 0) on axes,
+        the departure of the daily mean temperatures from their normal.
+        data is what plot_data gives for the plot, queried here when None.
+        """
+        with METRICS.timer('plot_render_seconds', kind='anomaly'):
+            anomalies = self.plot_data(('anomaly', year, month)) if data is None else data
+            axes.axhline(0, color='grey', linewidth=0.8)
+            axes.plot(anomalies['sample_date'], anomalies['anomaly'])
+            axes.fill_between(anomalies['sample_date'], anomalies['anomaly'], 0,
+                              where=anomalies['anomaly'] > 0, color='tab:red', alpha=0.3)
+            axes.fill_between(anomalies['sample_date'], anomalies['anomaly'], 0,
+                              where=anomalies['anomaly'] < 0, color='tab:blue', alpha=0.3)
+            axes.set_xlabel('Date')
+            axes.set_ylabel('Anomaly (Celsius)')
+            base_start, base_end = self.climatology.base
+            period = f"{year}/{month}" if month else str(year)
+            axes.set_title(f'Daily Temperature Anomaly for:{period} against {base_start} to {base_end}')
+            axes.figure.autofmt_xdate()
+
+    def draw(self, axes, spec: tuple, from_summary: bool = False, data=None):
+        """
+        draw the plot of spec on axes, spec is ("boxplot", start_year, end_year),
+        ("lineplot", year, month), ("normal_lineplot", year, month) or ("anomaly", year, month),
+        from_summary is handed to draw_boxplot, data is what plot_data gives for spec, or None.
+        """
+        kind, first, second = spec
+        if kind == 'boxplot':
+            self.draw_boxplot(axes, first, second, from_summary, data)
+        elif kind == 'lineplot':
+            self.draw_lineplot(axes, first, second, data=data)
+        elif kind == 'normal_lineplot':
+            self.draw_lineplot(axes, first, second, normal_band=True, data=data)
+        elif kind == 'anomaly':
+            self.draw_anomaly_plot(axes, first, second, data)
+        else:
+            raise ValueError(f"unknown plot {kind}")
+
+    def generate_boxplot(self, start_year: int, end_year: int, from_summary: bool = False):
         """
         generate a boxplot for temperature distributions monthly
         from start year to end year
         """
-        # save all years weather in one dictionary monthly {1:[all January]...}
-        years = range(start_year, end_year+1)
-        monthly_weather_data = {}
-        for year in years:
-            weather_data_year = self.receive_and_format_data(year)
-            for month, temps in weather_data_year.items():
-                if month in monthly_weather_data:
-                    monthly_weather_data[month] += temps
-                else:
-                    monthly_weather_data[month] = temps
-
-        # check exiting month data and use [] for missing month [[],[Feb]]
-        monthly_weather_data_for_plot = []
-        for month in range(1, 13):
-            if month in monthly_weather_data:
-                monthly_weather_data_for_plot.append(monthly_weather_data[month])
-            else:
-                monthly_weather_data_for_plot.append([])
-
-        # boxplot
-        plot_title = 'Monthly Temperature Distribution for:' + str(start_year) + ' to ' + str(end_year)
-        plt.figure()
-        plt.boxplot(monthly_weather_data_for_plot)
-        plt.xlabel('Month')
-        plt.ylabel('Temperature (Celsius)')
-        plt.title(plot_title)
-        plt.xlim(0, 13)
+        import matplotlib.pyplot as plt
+        figure = plt.figure()
+        self.draw_boxplot(figure.gca(), start_year, end_year, from_summary)
+        Path("./images").mkdir(parents=True, exist_ok=True)
+        save_path = f"./images/{plot_file_stem(('boxplot', start_year, end_year))}.jpg"
+        with METRICS.timer('plot_save_seconds', kind='boxplot'):
+            figure.savefig(save_path)
+        plt.show()
+
+    def generate_lineplot(self, year: int, month: int, normal_band: bool = False):
+        """
+        generate a lineplot for temperature changing for specific year and month,
+        with normal_band over the normal band of the days
+        """
+        import matplotlib.pyplot as plt
+        figure = plt.figure()
+        self.draw_lineplot(figure.gca(), year, month, normal_band)
         Path("./images").mkdir(parents=True, exist_ok=True)
-        save_path = f'./images/boxplot_from{start_year}to{end_year}.jpg'
-        plt.savefig(save_path)
+        save_path = f"./images/{plot_file_stem(('lineplot', year, month))}.jpg"
+        with METRICS.timer('plot_save_seconds', kind='lineplot'):
+            figure.savefig(save_path)
         plt.show()
 
-    def generate_lineplot(self, year: int, month: int) -> dict:
+    def generate_anomaly_plot(self, year: int, month: int = 0):
         """
-        generate a lineplot for temperature changing for specific year and month
+        generate a line plot of the daily anomalies of year and month, of the whole year when month is 0
         """
-        weather_data_month = self.receive_and_format_data(year, month)
-        days = weather_data_month.keys()
-        temps = weather_data_month.values()
-        plt.plot(days, temps)
-        plt.xlabel('Day')
-        plt.ylabel('Temperature (Celsius)')
-        plot_title = 'Daily Temperature Distribution for:'+ str(year) + '/' + str(month)
-        plt.title(plot_title)
+        import matplotlib.pyplot as plt
+        figure = plt.figure()
+        self.draw_anomaly_plot(figure.gca(), year, month)
         Path("./images").mkdir(parents=True, exist_ok=True)
-        save_path = f'./images/lineplot_{year}-{month}.jpg'
-        plt.savefig(save_path)
+        save_path = f"./images/{plot_file_stem(('anomaly', year, month))}.jpg"
+        with METRICS.timer('plot_save_seconds', kind='anomaly'):
+            figure.savefig(save_path)
         plt.show()
 
+    def render_image(self, spec: tuple, image_format: str = 'png', from_summary: bool = False,
+                     draw_lock=None) -> bytes:
+        """
+        render one plot without a display and output the encoded image.
+        spec and from_summary are as in draw.
+        draw_lock is an optional lock held while matplotlib draws and encodes,
+        the data is queried before taking it.
+        """
+        from matplotlib.backends.backend_agg import FigureCanvasAgg
+        from matplotlib.figure import Figure
+        data = self.plot_data(spec, from_summary)
+        with draw_lock or nullcontext():
+            figure = Figure()
+            FigureCanvasAgg(figure)
+            self.draw(figure.add_subplot(), spec, from_summary, data)
+            image = io.BytesIO()
+            with METRICS.timer('plot_save_seconds', kind=spec[0]):
+                figure.savefig(image, format=image_format)
+        return image.getvalue()
+
+    def render_batch(self, specs: list, out_dir: str = './images', processes: int = None,
+                     image_format: str = 'jpg') -> list:
+        """
+        render plots without a display, in parallel on a pool of processes
+        (default one per core), each plot on its own Agg figure.
+        specs is a list of the plot specs of draw.
+        output one {"spec": spec, "path": ..., "seconds": ..., "render_seconds": ..., "save_seconds": ...}
+        per spec, in the order of specs, seconds is the time the worker spent querying, drawing and
+        saving the plot. The render and save times of the workers are also recorded in this process' METRICS.
+        """
+        Path(out_dir).mkdir(parents=True, exist_ok=True)
+        with ProcessPoolExecutor(max_workers=processes, initializer=_init_render_worker,
+                                 initargs=(self.db_name, self.table_name, self.location,
+                                           self.export_dir)) as executor:
+            results = list(executor.map(_render_spec, specs, repeat(out_dir), repeat(image_format)))
+        for result in results:
+            METRICS.observe('plot_render_seconds', result['render_seconds'], kind=result['spec'][0])
+            METRICS.observe('plot_save_seconds', result['save_seconds'], kind=result['spec'][0])
+        return results
+
+
+_render_plot_operations = None
+
+
+def _init_render_worker(db_name: str, table_name: str, location: str, export_dir: str = None):
+    """ open one PlotOperations per worker process, reused for all its plots """
+    global _render_plot_operations
+    _render_plot_operations = PlotOperations(db_name, table_name, location, export_dir)
+
+
+def _render_spec(spec: tuple, out_dir: str, image_format: str) -> dict:
+    """ render one batch spec to a file with the Agg canvas, no pyplot state involved """
+    from matplotlib.backends.backend_agg import FigureCanvasAgg
+    from matplotlib.figure import Figure
+    start = time.perf_counter()
+    figure = Figure()
+    FigureCanvasAgg(figure)
+    _render_plot_operations.draw(figure.add_subplot(), spec)
+    save_path = f'{out_dir}/{plot_file_stem(spec)}.{image_format}'
+    rendered = time.perf_counter()
+    figure.savefig(save_path)
+    saved = time.perf_counter()
+    return {'spec': spec, 'path': save_path, 'seconds': saved - start,
+            'render_seconds': rendered - start, 'save_seconds': saved - rendered}
+
+
 if __name__ == "__main__":
     db_name = 'weather.sqlite'
     table_name = 'weather'
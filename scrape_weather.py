@@ -21,47 +21,184 @@ class. There should be no scraping code anywhere else in the program.
 
 from datetime import datetime
 from html.parser import HTMLParser
-import urllib.request
+import re
+from collections import deque
+from contextlib import closing
+from concurrent.futures import ThreadPoolExecutor
+import urllib.error
 import pprint
+from daily_weather import DailyWeather
+from http_client import HttpClient
+from metrics import METRICS
+from page_cache import PageNotCached
 
-class WeatherScraper(HTMLParser):
-    """docstring for WeatherScraper."""
+BASE_URL = "http://climate.weather.gc.ca/climate_data/daily_data_e.html"
+FIRST_YEAR = 1840
+STATION_ID = 27174
+STATIONS = {27174: "Winnipeg, MB"}
+
+MONTHS = {name: number for number, name in enumerate(
+    ["January", "February", "March", "April", "May", "June", "July",
+     "August", "September", "October", "November", "December"], start=1)}
+DATE_TITLE = re.compile(r"([A-Z][a-z]+) (\d{1,2}), (\d{4})$")
+NUMBER = re.compile(r"-?\d+(?:\.\d+)?$")
+
+
+class PageLayoutError(ValueError):
+    """ a downloaded page has no daily data table we can read, the site layout changed """
+
+
+class DailyTableParser(HTMLParser):
+    """
+    Parse the daily data table of a page into typed rows.
+    Each table row starts with <th><abbr title="May 1, 2018">, followed by the
+    Max, Min and Mean temperature <td> cells. A cell holding no number (missing
+    "M" cells, blanks) is None.
+    """
 
     def __init__(self):
         HTMLParser.__init__(self)
-        self.recording = 0
-        self.data_list = []
-        self.weather = {}
-        self.stop = False
+        self.dates = []
+        self.rows = []
+        self.current_date = None
+        self.cells = []
+        self.in_header = False
+        self.in_cell = False
+        self.cell_value = None
+
+    @classmethod
+    def parse(cls, page: bytes) -> tuple:
+        """
+        Input the raw bytes of a daily data page.
+        Output (dates, rows):
+        • dates = every date listed in the table, e.g. ["2018-05-01", ...]
+        • rows = [("2018-05-01", 12.0, 5.6, 7.1), ...] for the days with all three values
+        Raise PageLayoutError for a page without a table body or without a dated row,
+        the site always lists the days of the month asked for (or of its earliest month),
+        so that is a changed layout and not the end of the history.
+        The table is looked for after the data-table class, or from the start without it.
+        """
+        html = page.decode('utf-8', errors='replace')
+        anchor = html.find('data-table')
+        table = html.find('<tbody', anchor if anchor >= 0 else 0)
+        if table < 0:
+            raise PageLayoutError('no daily data table on the page')
+        end = html.find('</tbody>', table)
+        parser = cls()
+        parser.feed(html[table:end if end >= 0 else len(html)])
+        parser.close()
+        if not parser.dates:
+            raise PageLayoutError('no dated row in the daily data table')
+        return parser.dates, parser.rows
 
     def handle_starttag(self, tag, attrs):
-        if tag == 'abbr':
-            if attrs[0][1]:
-                try:
-                    date = attrs[0][1]
-                    self.data_list.append(datetime.strptime(date, '%B %d, %Y').strftime('%Y-%m-%d'))
-                except:
-                    return
+        if tag == 'tr':
+            self.current_date = None
+            self.cells = []
+        elif tag == 'th':
+            self.in_header = True
+        elif tag == 'abbr' and self.in_header:
+            match = DATE_TITLE.match(dict(attrs).get('title') or '')
+            if match and match.group(1) in MONTHS:
+                self.current_date = (f"{match.group(3)}-{MONTHS[match.group(1)]:02d}"
+                                     f"-{int(match.group(2)):02d}")
+                self.dates.append(self.current_date)
+        elif tag == 'td' and self.current_date:
+            self.in_cell = True
+            self.cell_value = None
 
-        if tag not in ['td']:
-            return
+    def handle_endtag(self, tag):
+        if tag == 'th':
+            self.in_header = False
+        elif tag == 'td' and self.in_cell:
+            self.in_cell = False
+            self.cells.append(self.cell_value)
+        elif tag == 'tr' and self.current_date:
+            if len(self.cells) >= 3 and None not in self.cells[:3]:
+                self.rows.append((self.current_date, *self.cells[:3]))
+            self.current_date = None
 
-        if self.recording:
-            self.recording += 1
-            return
+    def handle_data(self, data):
+        if self.in_cell and self.cell_value is None and len(self.cells) < 3:
+            data = data.strip()
+            if NUMBER.match(data):
+                self.cell_value = float(data)
 
-        if tag in ['td']:
-            self.recording = 1
 
+class WeatherScraper():
+    """docstring for WeatherScraper."""
 
-    def handle_endtag (self, tag):
-        if tag in ['td'] and self.recording:
-            self.recording -= 1
+    def __init__(self, base_url: str = BASE_URL, cache=None, station_id: int = STATION_ID,
+                 http: HttpClient = None):
+        """
+        cache is an optional PageCache for the downloaded pages,
+        station_id the climate station to scrape.
+        http is the HttpClient the pages are downloaded with, scrapers of several stations
+        can share one so they share its connections and rate limit.
+        self.weather is a DailyWeather, a mapping of the same shape as a dict of dicts.
+        """
+        self.base_url = base_url
+        self.cache = cache
+        self.station_id = station_id
+        self.http = http or HttpClient()
+        self.weather = DailyWeather()
+        self.stop = False
+
+    def month_url(self, year: int, month: int) -> str:
+        """ the daily data page url for year and month """
+        return (self.base_url
+                + "?StationID=" + str(self.station_id)
+                + "&timeframe=2&StartYear=1840"
+                + "&EndYear=" + str(year)
+                + "&Day=1&Year=" + str(year)
+                + "&Month=" + str(month) + "#")
 
+    def fetch_page(self, year: int, month: int, revalidate: bool = False) -> bytes:
+        """
+        download the page for year and month, going through self.cache when there is one.
+        revalidate asks the site about a cached page even when the cache holds it as fresh.
+        In offline mode a page missing from the cache raises PageNotCached, so a run
+        stops instead of taking the month for one the site does not have.
+        """
+        url = self.month_url(year, month)
+        if not self.cache:
+            return self.http.get(url)[0]
 
-    def handle_data (self, data):
-        if self.recording:
-            self.data_list.append(data)
+        cached = self.cache.load(self.station_id, year, month)
+        if cached and (self.cache.offline or not revalidate) and self.cache.is_fresh(cached[1], year, month):
+            METRICS.increment('page_cache_lookups', result='hit')
+            return cached[0]
+        if self.cache.offline:
+            METRICS.increment('page_cache_lookups', result='offline_miss')
+            raise PageNotCached(f"{self.station_id} {year:04d}-{month:02d}")
+
+        try:
+            body, headers = self.http.get(url, self.cache.validators(cached[1]) if cached else None)
+            self.cache.store(self.station_id, year, month, body, headers)
+            METRICS.increment('page_cache_lookups', result='miss')
+        except urllib.error.HTTPError as error:
+            if error.code != 304 or not cached:
+                raise
+            METRICS.increment('page_cache_lookups', result='revalidated')
+            self.cache.refresh(self.station_id, year, month)
+            body = cached[0]
+        return body
+
+    def scrape_month(self, year: int, month: int, revalidate: bool = False) -> tuple:
+        """
+        Input year and month to scrape, does not touch self.weather so it is
+        safe to call from worker threads. revalidate is passed on to fetch_page.
+        Output (page_dates, daily_temps):
+        • page_dates = every date listed on the page, in page order
+        • daily_temps = {“2018-06-01”: {“Max”: 12.0, “Min”: 5.6, “Mean”: 7.1}}
+        """
+        with METRICS.timer('scrape_month_seconds'):
+            page = self.fetch_page(year, month, revalidate)
+            with METRICS.timer('parse_page_seconds'):
+                page_dates, rows = DailyTableParser.parse(page)
+        daily_temps = {date: {"Max": max_temp, "Min": min_temp, "Mean": mean_temp}
+                       for date, max_temp, min_temp, mean_temp in rows}
+        return page_dates, daily_temps
 
     def monthly_scraping(self, year: int, month: int, date_for_stop: str = None):
         """
@@ -70,54 +207,20 @@ class WeatherScraper(HTMLParser):
         • daily_temps = {“Max”: 12.0, “Min”: 5.6, “Mean”: 7.1}
         • weather = {“2018-06-01”: daily_temps, “2018-06-02”: daily_temps}
         """
-        url = ("http://climate.weather.gc.ca/"
-                           + "climate_data/daily_data_e.html"
-                           + "?StationID=27174"
-                           + "&timeframe=2&StartYear=1840"
-                           + "&EndYear=" + str(year)
-                           + "&Day=1&Year=" + str(year)
-                           + "&Month=" + str(month) + "#")
+        page_dates, daily_temps = self.scrape_month(year, month)
 
-        myparser = WeatherScraper()
-        with urllib.request.urlopen(url) as response:
-            html = str(response.read())
-        myparser.feed(html)
+        if date_for_stop and date_for_stop in page_dates:
+            page_dates = page_dates[page_dates.index(date_for_stop)+1:]
+            self.stop = True
 
-        useful_data = myparser.data_list
-        if date_for_stop:
-            if date_for_stop in useful_data:
-                useful_data = useful_data[useful_data.index(date_for_stop)+1:]
+        rows = []
+        for date in page_dates:
+            if date in self.weather:
                 self.stop = True
-
-        daily_temps = {}
-        count = 0
-        current_date = ""
-
-        for d in useful_data:
-            try:
-                datetime.strptime(d, '%Y-%m-%d')
-                current_date = d
-                if current_date in self.weather:
-                    self.stop = True
-
-                daily_temps[current_date] = []
-                count = 0
-            except:
-                if d and current_date:
-                    if 'Legend' not in d and d != 'E':
-                        count += 1
-                        if count <= 3:
-                            try:
-                                daily_temps[current_date].append(float(d))
-                            except:
-                                daily_temps.pop(current_date, None)
-        keys = ["Max", "Min", "Mean"]
-        for date, temp in daily_temps.items():
-            daily_temps[date] = {keys[i]: temp[i] for i in range(len(keys))}
-
-        self.weather.update(daily_temps)
-
-
+            if date in daily_temps:
+                temps = daily_temps[date]
+                rows.append((date, temps["Max"], temps["Min"], temps["Mean"]))
+        self.weather.add_rows(rows)
 
     def start_scraping(self, date_for_stop: str = None):
         """
@@ -125,21 +228,145 @@ class WeatherScraper(HTMLParser):
         Output A dictionary of dictionaries. For example:
         • daily_temps = {“Max”: 12.0, “Min”: 5.6, “Mean”: 7.1}
         • weather = {“2018-06-01”: daily_temps, ... “2020-12-1”: daily_temps}
+        It stops at the end of the history or at FIRST_YEAR, whichever comes first.
         """
         today = datetime.today()
         year = today.year
         month = today.month
-        while not self.stop:
+        while not self.stop and year >= FIRST_YEAR:
             self.monthly_scraping(year, month, date_for_stop)
-            print(year, month)
+            METRICS.increment('months_scraped')
             month -= 1
             if month == 0:
                 month = 12
                 year -= 1
 
+    def month_available(self, year: int, month: int, pages: dict = None) -> bool:
+        """
+        the site answers a month before its history with the earliest month it has,
+        so a month is available when its page lists at least one date of that month.
+        pages caches the scraped pages by month index so they can be reused.
+        """
+        index = year * 12 + month - 1
+        if pages is not None and index in pages:
+            page_dates = pages[index][0]
+        else:
+            page = self.scrape_month(year, month)
+            if pages is not None:
+                pages[index] = page
+            page_dates = page[0]
+        prefix = f"{year:04d}-{month:02d}"
+        return any(d.startswith(prefix) for d in page_dates)
+
+    def find_earliest_month(self, pages: dict = None) -> tuple:
+        """
+        find the earliest available (year, month) with an exponential search
+        backward from the current month followed by a binary search,
+        about 2 * log2(months of history) requests instead of one per month.
+        """
+        today = datetime.today()
+        floor = FIRST_YEAR * 12
+        available = today.year * 12 + today.month - 1
+        unavailable = None
+        step = 1
+        while available > floor:
+            probe = max(available - step, floor)
+            if self.month_available(probe // 12, probe % 12 + 1, pages):
+                available = probe
+                step *= 2
+            else:
+                unavailable = probe
+                break
+        if unavailable is None:
+            return available // 12, available % 12 + 1
+
+        while available - unavailable > 1:
+            middle = (available + unavailable) // 2
+            if self.month_available(middle // 12, middle % 12 + 1, pages):
+                available = middle
+            else:
+                unavailable = middle
+        return available // 12, available % 12 + 1
+
+    def start_scraping_concurrent(self, date_for_stop: str = None, max_workers: int = 8):
+        """
+        Same output as start_scraping, but up to max_workers months are fetched in parallel,
+        see iter_monthly_batches. With date_for_stop only the days after that date are kept.
+        The results are merged newest month first, the same order start_scraping uses.
+        """
+        for _, _, daily_temps in self.iter_monthly_batches(None, date_for_stop, max_workers):
+            for date, temps in daily_temps.items():
+                self.weather.setdefault(date, temps)
+        self.stop = True
+
+    def _prefetch(self, months, max_workers: int, revalidate: bool = False):
+        """
+        Generator of (year, month, page_dates, daily_temps) for the (year, month) months
+        in their order, as scrape_month gives them, with up to max_workers months downloaded
+        ahead of the consumer. The downloads not started yet are cancelled when it is closed.
+        """
+        months = iter(months)
+        with ThreadPoolExecutor(max_workers=max_workers) as executor:
+            pending = deque()
+            try:
+                while True:
+                    for year, month in months:
+                        pending.append((year, month, executor.submit(self.scrape_month, year, month, revalidate)))
+                        if len(pending) == max_workers:
+                            break
+                    if not pending:
+                        return
+                    year, month, future = pending.popleft()
+                    yield (year, month) + future.result()
+            finally:
+                for _, _, future in pending:
+                    future.cancel()
+
+    def iter_monthly_batches(self, start: tuple = None, date_for_stop: str = None, max_workers: int = 4):
+        """
+        Generator of per-month batches, from start (a (year, month) tuple, default
+        the current month) back in time until a month is no longer available
+        or the month of date_for_stop has been scraped.
+        Up to max_workers months are downloaded ahead of the consumer, nothing is
+        kept in self.weather so memory does not grow with the length of the history.
+        Output (year, month, daily_temps) tuples, daily_temps as in scrape_month.
+        """
+        today = datetime.today()
+        newest = start[0] * 12 + start[1] - 1 if start else today.year * 12 + today.month - 1
+        oldest = FIRST_YEAR * 12
+        if date_for_stop:
+            stop_date = datetime.strptime(date_for_stop, '%Y-%m-%d')
+            oldest = max(oldest, stop_date.year * 12 + stop_date.month - 1)
+
+        months = ((index // 12, index % 12 + 1) for index in range(newest, oldest - 1, -1))
+        pages = self._prefetch(months, max_workers)
+        with closing(pages):
+            for year, month, page_dates, daily_temps in pages:
+                prefix = f"{year:04d}-{month:02d}"
+                month_dates = [d for d in page_dates if d.startswith(prefix)]
+                if not month_dates:
+                    return
+                yield year, month, {d: daily_temps[d] for d in month_dates
+                                    if d in daily_temps and not (date_for_stop and d <= date_for_stop)}
+
+    def iter_months(self, months: list, max_workers: int = 4, revalidate: bool = False):
+        """
+        Generator of the batches of the given (year, month) months, in their order,
+        with up to max_workers months downloaded ahead of the consumer.
+        revalidate checks every cached page with the site, see fetch_page.
+        A month the site does not have gives an empty batch.
+        Output (year, month, daily_temps) tuples, daily_temps as in scrape_month.
+        """
+        pages = self._prefetch(months, max_workers, revalidate)
+        with closing(pages):
+            for year, month, _, daily_temps in pages:
+                prefix = f"{year:04d}-{month:02d}"
+                yield year, month, {d: temps for d, temps in daily_temps.items() if d.startswith(prefix)}
+
 
 if __name__ == "__main__":
     WEATHER = WeatherScraper()
     # WEATHER.start_scraping()
     WEATHER.start_scraping('1996-11-05')
-    pprint.pprint(WEATHER.weather)
+    pprint.pprint(dict(WEATHER.weather))
+    print(METRICS.to_prometheus())
@@ -15,18 +15,34 @@ class. There should be no user prompt type code anywhere else in the
 program.
 """
 
+import importlib
+import threading
 import wx
-from db_operations import DBOperations
-from scrape_weather import WeatherScraper
-from plot_operations import PlotOperations
+import wx.lib.newevent
+
+# the scraper, database and plotting modules (and numpy / matplotlib behind them)
+# are imported on first use so the window shows up right away, see prewarm
+PREWARMED_MODULES = ('matplotlib.figure', 'plot_operations', 'ingest_pipeline', 'page_cache')
+
+# posted by the ingest worker thread to the frame, wx.PostEvent is thread safe
+IngestProgressEvent, EVT_INGEST_PROGRESS = wx.lib.newevent.NewEvent()
+IngestDoneEvent, EVT_INGEST_DONE = wx.lib.newevent.NewEvent()
 
 class WeatherProcessor(wx.Frame):
     """docstring for WeatherProcessor."""
 
-    def __init__(self):
-        """initialize for WeatherProcessor. Use wxpython for user interaction"""
+    def __init__(self, prewarm: bool = True):
+        """
+        initialize for WeatherProcessor. Use wxpython for user interaction
+        prewarm imports the heavy modules on a background thread once the window is shown.
+        """
         self.db_name = 'weather.sqlite'
         self.table_name = 'weather'
+        self.ingest_thread = None
+        self.cancel_event = threading.Event()
+        # set when the frame closes, the ingest worker stops posting to it
+        self.closing = threading.Event()
+        self._plot_operations = None
 
         super().__init__(parent=None, title='Weather Processor')
         panel = wx.Panel(self)
@@ -39,13 +55,28 @@ class WeatherProcessor(wx.Frame):
         install_lbl.SetLabel('Install All or Update Database')
         my_sizer.Add(install_lbl,0,wx.ALL | wx.ALIGN_LEFT,5)
 
-        install_all_btn = wx.Button(panel, label='Install All')
-        install_all_btn.Bind(wx.EVT_BUTTON, self.clear_db_and_install_all_weather_data)
-        my_sizer.Add(install_all_btn, 0, wx.ALL | wx.LEFT, 5)
+        self.install_all_btn = wx.Button(panel, label='Install All')
+        self.install_all_btn.Bind(wx.EVT_BUTTON, self.clear_db_and_install_all_weather_data)
+        my_sizer.Add(self.install_all_btn, 0, wx.ALL | wx.LEFT, 5)
+
+        self.update_btn = wx.Button(panel, label='Update Database')
+        self.update_btn.Bind(wx.EVT_BUTTON, self.update_db)
+        my_sizer.Add(self.update_btn, 0, wx.ALL | wx.LEFT, 5)
+
+        self.cancel_btn = wx.Button(panel, label='Cancel')
+        self.cancel_btn.Bind(wx.EVT_BUTTON, self.cancel_ingest)
+        self.cancel_btn.Disable()
+        my_sizer.Add(self.cancel_btn, 0, wx.ALL | wx.LEFT, 5)
+
+        self.ingest_gauge = wx.Gauge(panel, range=100)
+        my_sizer.Add(self.ingest_gauge, 0, wx.ALL | wx.EXPAND, 5)
 
-        update_btn = wx.Button(panel, label='Update Database')
-        update_btn.Bind(wx.EVT_BUTTON, self.update_db)
-        my_sizer.Add(update_btn, 0, wx.ALL | wx.LEFT, 5)
+        self.ingest_status_lbl = wx.StaticText(panel)
+        my_sizer.Add(self.ingest_status_lbl, 0, wx.ALL | wx.EXPAND, 5)
+
+        self.Bind(EVT_INGEST_PROGRESS, self.on_ingest_progress)
+        self.Bind(EVT_INGEST_DONE, self.on_ingest_done)
+        self.Bind(wx.EVT_CLOSE, self.on_close)
 
         # boxplot part
         boxplot_lbl = wx.StaticText(panel)
@@ -96,59 +127,164 @@ class WeatherProcessor(wx.Frame):
         self.month_text_ctrl = wx.TextCtrl(panel)
         my_sizer.Add(self.month_text_ctrl, 0, wx.ALL | wx.EXPAND, 5)
 
+        self.normal_band_check = wx.CheckBox(panel, label='Show the 1991-2020 normal band')
+        my_sizer.Add(self.normal_band_check, 0, wx.ALL | wx.LEFT, 5)
+
         lineplot_btn = wx.Button(panel, label='Generate Lineplot')
         lineplot_btn.Bind(wx.EVT_BUTTON, self.lineplot)
         my_sizer.Add(lineplot_btn, 0, wx.ALL | wx.LEFT, 5)
 
+        anomaly_btn = wx.Button(panel, label='Generate Anomaly Plot')
+        anomaly_btn.Bind(wx.EVT_BUTTON, self.anomaly_plot)
+        my_sizer.Add(anomaly_btn, 0, wx.ALL | wx.LEFT, 5)
+
 
         panel.SetSizer(my_sizer)
         self.Show()
+        if prewarm:
+            threading.Thread(target=self.prewarm, daemon=True).start()
+
+    @staticmethod
+    def prewarm():
+        """
+        import what the buttons need ahead of the first click. pyplot is left to
+        the first plot, it picks the GUI backend and belongs on the main thread.
+        """
+        for module in PREWARMED_MODULES:
+            importlib.import_module(module)
+
+    def plot_operations(self):
+        """
+        the PlotOperations of every plot, opened on the first one and kept with its
+        query cache, so plotting the same years again is served from memory.
+        """
+        if self._plot_operations is None:
+            from db_operations import QueryCache
+            from plot_operations import PlotOperations
+            self._plot_operations = PlotOperations(self.db_name, self.table_name, cache=QueryCache())
+        return self._plot_operations
 
     def boxplot(self, event):
         " Generate and save boxplot "
         start_year = self.start_year_text_ctrl.GetValue()
         end_year = self.end_year_text_ctrl.GetValue()
-        db_name = 'weather.sqlite'
-        table_name = 'weather'
-        my_plot_operations = PlotOperations(db_name, table_name)
+        my_plot_operations = self.plot_operations()
         my_plot_operations.generate_boxplot(int(start_year), int(end_year))
 
     def lineplot(self, event):
         " Generate and save lineplot "
         year = self.year_text_ctrl.GetValue()
         month = self.month_text_ctrl.GetValue()
-        db_name = 'weather.sqlite'
-        table_name = 'weather'
-        my_plot_operations = PlotOperations(db_name, table_name)
-        my_plot_operations.generate_lineplot(int(year), int(month))
+        my_plot_operations = self.plot_operations()
+        my_plot_operations.generate_lineplot(int(year), int(month), self.normal_band_check.GetValue())
+
+    def anomaly_plot(self, event):
+        " Generate and save the daily anomaly plot of the year and month, of the whole year without a month "
+        year = self.year_text_ctrl.GetValue()
+        month = self.month_text_ctrl.GetValue()
+        my_plot_operations = self.plot_operations()
+        my_plot_operations.generate_anomaly_plot(int(year), int(month or 0))
 
     def clear_db_and_install_all_weather_data(self, event):
         " clear db and install all weather data "
-        myweather = WeatherScraper()
-        myweather.start_scraping()
-        weather_data_from_weather_scraper = myweather.weather
-        db_operations = DBOperations(self.db_name)
-        db_operations.initialize_db(self.table_name)
-        db_operations.purge_data(self.table_name)
-        db_operations.save_data(weather_data_from_weather_scraper, self.table_name)
+        self.start_ingest('install')
 
     def update_db(self, event):
         " install missing weather data "
-        myweather = WeatherScraper()
-        with DBOperations(self.db_name) as dbcm:
-            dbcm.execute(f"select max(sample_date) from {self.table_name};")
-            latest_date = dbcm.fetchall()[0][0]
-
-        print('latest date in db', latest_date)
-        myweather.start_scraping(latest_date)
-        weather_data_from_weather_scraper = myweather.weather
-        db_operations = DBOperations(self.db_name)
-        db_operations.initialize_db(self.table_name)
-        db_operations.save_data(weather_data_from_weather_scraper, self.table_name)
+        self.start_ingest('update')
+
+    def start_ingest(self, mode: str):
+        """
+        run the install or update on a background thread so the window and
+        the plot buttons stay responsive while it downloads.
+        """
+        if self.ingest_thread and self.ingest_thread.is_alive():
+            return
+        self.cancel_event.clear()
+        self.install_all_btn.Disable()
+        self.update_btn.Disable()
+        self.cancel_btn.Enable()
+        self.ingest_gauge.SetValue(0)
+        self.ingest_status_lbl.SetLabel('Starting...')
+        self.ingest_thread = threading.Thread(target=self.run_ingest, args=(mode,), daemon=True)
+        self.ingest_thread.start()
+
+    def run_ingest(self, mode: str):
+        """ worker thread body, talks to the frame only through posted events """
+        def progress(months_done, months_total, rows_written, eta_seconds):
+            if self.closing.is_set():
+                return
+            wx.PostEvent(self, IngestProgressEvent(months_done=months_done, months_total=months_total,
+                                                   rows_written=rows_written, eta_seconds=eta_seconds))
+
+        error = None
+        cancelled = False
+        months = 0
+        pipeline = None
+        try:
+            from ingest_pipeline import IngestPipeline
+            from page_cache import PageCache
+            from scrape_weather import WeatherScraper
+            pipeline = IngestPipeline(self.db_name, self.table_name, WeatherScraper(cache=PageCache()),
+                                      progress=progress, cancel_event=self.cancel_event)
+            months = pipeline.install() if mode == 'install' else pipeline.update()
+            cancelled = pipeline.cancelled
+        except Exception as exception:
+            error = exception
+        finally:
+            if pipeline:
+                pipeline.db_operations.close()
+        if not self.closing.is_set():
+            wx.PostEvent(self, IngestDoneEvent(months=months, cancelled=cancelled, error=error))
+
+    def cancel_ingest(self, event):
+        " stop the running install or update at the next month "
+        self.cancel_event.set()
+        self.cancel_btn.Disable()
+        self.ingest_status_lbl.SetLabel('Cancelling at the end of this month...')
+
+    def on_close(self, event):
+        """
+        cancel a running install or update and wait for it to write its last month,
+        it resumes from its checkpoint next time, then let the frame close.
+        """
+        self.closing.set()
+        self.cancel_event.set()
+        if self.ingest_thread and self.ingest_thread.is_alive():
+            self.ingest_thread.join(timeout=30)
+        if self._plot_operations is not None:
+            self._plot_operations.db_operations.close()
+        event.Skip()
+
+    def on_ingest_progress(self, event):
+        " show the progress posted by the worker thread "
+        status = f'{event.months_done} months, {event.rows_written} rows written'
+        if event.months_total:
+            self.ingest_gauge.SetValue(min(100, 100 * event.months_done // event.months_total))
+            status = f'{event.months_done}/{event.months_total} months, {event.rows_written} rows written'
+        else:
+            self.ingest_gauge.Pulse()
+        if event.eta_seconds is not None:
+            status += f', {int(event.eta_seconds) // 60}:{int(event.eta_seconds) % 60:02d} left'
+        if not self.cancel_event.is_set():
+            self.ingest_status_lbl.SetLabel(status)
+
+    def on_ingest_done(self, event):
+        " the worker thread finished "
+        self.install_all_btn.Enable()
+        self.update_btn.Enable()
+        self.cancel_btn.Disable()
+        if event.error:
+            self.ingest_status_lbl.SetLabel(f'Failed: {event.error}')
+        elif event.cancelled:
+            self.ingest_status_lbl.SetLabel(f'Cancelled after {event.months} months, run it again to resume')
+        else:
+            self.ingest_gauge.SetValue(100)
+            self.ingest_status_lbl.SetLabel(f'Done, {event.months} months')
 
 if __name__ == '__main__':
     app = wx.App()
     frame = WeatherProcessor()
-    frame.SetSize(500,600)
+    frame.SetSize(500,820)
     app.MainLoop()
     input("press enter to finish")
@@ -0,0 +1,249 @@
+"""
+Headless HTTP service for the plots and daily series.
+• Serve the boxplot and lineplot as PNG or JPEG images and the daily series
+as JSON over a local HTTP API, without a display:
+◦ /boxplot.png?start=2000&end=2020 (&summary=1 draws it from the monthly summaries)
+◦ /lineplot.jpg?year=2020&month=1
+◦ /series.json?start=2020-01-01&end=2020-02-01&columns=avg_temp,min_temp
+◦ /metrics, the METRICS of the process in the Prometheus text format
+Every request takes &location=... to pick the station.
+• Requests are handled concurrently on a pool of read-only database connections.
+• Query results are kept in a QueryCache shared by the pool, and responses
+are cached by their parameters and the data version of the table,
+so a repeated request is neither queried nor rendered again until save_data
+or purge_data change the data. Concurrent requests for the same response
+wait for a single render.
+"""
+
+from collections import OrderedDict
+from concurrent.futures import Future
+from contextlib import contextmanager
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+from urllib.parse import urlparse, parse_qs
+import argparse
+import hashlib
+import json
+import queue
+import threading
+import numpy as np
+from db_operations import DEFAULT_LOCATION, QueryCache
+from metrics import METRICS
+from plot_operations import PlotOperations
+
+# the columns /series.json serves next to sample_date
+SERIES_COLUMNS = ('min_temp', 'max_temp', 'avg_temp', 'year', 'month', 'day')
+CONTENT_TYPES = {'png': 'image/png', 'jpg': 'image/jpeg', 'jpeg': 'image/jpeg', 'json': 'application/json'}
+
+
+class WeatherService():
+    """
+    a threaded HTTP server over a pool of read-only PlotOperations, with a response cache keyed by data version
+    """
+
+    def __init__(self, db_name: str, table_name: str, host: str = '127.0.0.1', port: int = 8000,
+                 export_dir: str = None, pool_size: int = 4, cache_entries: int = 256,
+                 query_cache_bytes: int = 64 * 2 ** 20):
+        """
+        pool_size is the number of read-only connections shared by the request threads,
+        cache_entries the number of responses kept, least recently used first out.
+        export_dir reads the daily series from the columnar export, see PlotOperations.
+        query_cache_bytes bounds the QueryCache of query results shared by the pool.
+        """
+        self.table_name = table_name
+        self.cache_entries = cache_entries
+        self.query_cache = QueryCache(query_cache_bytes)
+        self.pool = queue.Queue()
+        for _ in range(pool_size):
+            self.pool.put(PlotOperations(db_name, table_name, export_dir=export_dir, read_only=True,
+                                         cache=self.query_cache))
+        self._cache = OrderedDict()
+        self._in_flight = {}
+        self._lock = threading.Lock()
+        # matplotlib is not thread safe, the drawing takes turns, the queries before it do not
+        self._render_lock = threading.Lock()
+        self.httpd = ThreadingHTTPServer((host, port), self._make_handler())
+        self.httpd.daemon_threads = True
+        self._thread = None
+
+    @property
+    def base_url(self) -> str:
+        """ the url the API is served under """
+        host, port = self.httpd.server_address[:2]
+        return f"http://{host}:{port}"
+
+    def __enter__(self):
+        self.start()
+        return self
+
+    def __exit__(self, exc_type, exc_val, exc_tb):
+        self.stop()
+
+    def start(self):
+        """ serve requests on a background thread """
+        self._thread = threading.Thread(target=self.httpd.serve_forever, daemon=True)
+        self._thread.start()
+
+    def stop(self):
+        """ shut the server down and close the pooled connections """
+        self.httpd.shutdown()
+        self.httpd.server_close()
+        while not self.pool.empty():
+            self.pool.get().db_operations.close()
+
+    @contextmanager
+    def plot_operations(self, location: str):
+        """ borrow a pooled PlotOperations set to location, waiting for one when all are in use """
+        plot_operations = self.pool.get()
+        try:
+            plot_operations.location = location
+            yield plot_operations
+        finally:
+            self.pool.put(plot_operations)
+
+    def cached(self, key: tuple, produce) -> bytes:
+        """
+        the response for key from the cache, or produced by produce() and cached.
+        A request for a key being produced by another thread waits for that result.
+        """
+        with self._lock:
+            if key in self._cache:
+                self._cache.move_to_end(key)
+                METRICS.increment('service_cache_lookups', result='hit')
+                return self._cache[key]
+            future = self._in_flight.get(key)
+            producer = future is None
+            if producer:
+                future = self._in_flight[key] = Future()
+        if not producer:
+            METRICS.increment('service_cache_lookups', result='wait')
+            return future.result()
+
+        METRICS.increment('service_cache_lookups', result='miss')
+        try:
+            body = produce()
+            future.set_result(body)
+        except Exception as exception:
+            future.set_exception(exception)
+            raise
+        finally:
+            with self._lock:
+                del self._in_flight[key]
+        with self._lock:
+            self._cache[key] = body
+            while len(self._cache) > self.cache_entries:
+                self._cache.popitem(last=False)
+        return body
+
+    def respond(self, path: str, query: dict) -> tuple:
+        """
+        output (content_type, body, etag) for the request of path and query.
+        raise KeyError for an unknown path and ValueError for bad parameters.
+        """
+        name, _, extension = path.strip('/').partition('.')
+        if name == 'metrics' and not extension:
+            return 'text/plain; version=0.0.4', METRICS.to_prometheus().encode('utf-8'), None
+        if extension not in CONTENT_TYPES or (name == 'series') != (extension == 'json'):
+            raise KeyError(path)
+        location = query.get('location', [DEFAULT_LOCATION])[0]
+
+        with self.plot_operations(location) as plot_operations:
+            version = plot_operations.db_operations.data_version(self.table_name)
+            if name == 'boxplot':
+                spec = ('boxplot', int(query['start'][0]), int(query['end'][0]))
+                from_summary = query.get('summary', ['0'])[0] == '1'
+                key = (spec, from_summary, location, extension, version)
+                produce = lambda: self.render(plot_operations, spec, extension, from_summary)
+            elif name == 'lineplot':
+                spec = ('lineplot', int(query['year'][0]), int(query['month'][0]))
+                if not 1 <= spec[2] <= 12:
+                    raise ValueError(f"month {spec[2]}")
+                key = (spec, False, location, extension, version)
+                produce = lambda: self.render(plot_operations, spec, extension, False)
+            elif name == 'series':
+                start_date = str(np.datetime64(query['start'][0], 'D'))
+                end_date = str(np.datetime64(query['end'][0], 'D'))
+                columns = tuple(query.get('columns', ['avg_temp'])[0].split(','))
+                if len(set(columns)) != len(columns) or not set(columns) <= set(SERIES_COLUMNS):
+                    raise ValueError(f"columns {','.join(columns)}, choose from {','.join(SERIES_COLUMNS)}")
+                key = ('series', start_date, end_date, columns, location, version)
+                produce = lambda: self.series(plot_operations, start_date, end_date, columns)
+            else:
+                raise KeyError(path)
+            body = self.cached(key, produce)
+        etag = '"' + hashlib.sha1(repr(key).encode('utf-8')).hexdigest() + '"'
+        return CONTENT_TYPES[extension], body, etag
+
+    def render(self, plot_operations: PlotOperations, spec: tuple, extension: str, from_summary: bool) -> bytes:
+        """ the encoded image of the plot spec """
+        return plot_operations.render_image(spec, 'jpeg' if extension == 'jpg' else extension, from_summary,
+                                            self._render_lock)
+
+    @staticmethod
+    def series(plot_operations: PlotOperations, start_date: str, end_date: str, columns: tuple) -> bytes:
+        """
+        the JSON of the daily series from start_date up to end_date,
+        {"location": ..., "sample_date": ["2020-01-01", ...], "avg_temp": [-20.1, ...]}
+        """
+        weather_data = plot_operations.fetch_range(start_date, end_date, ('sample_date',) + columns)
+        document = {'location': plot_operations.location,
+                    'sample_date': np.datetime_as_string(weather_data['sample_date']).tolist()}
+        document.update({column: weather_data[column].tolist() for column in columns})
+        return json.dumps(document).encode('utf-8')
+
+    def _make_handler(self):
+        service = self
+
+        class Handler(BaseHTTPRequestHandler):
+            protocol_version = 'HTTP/1.1'
+
+            def do_GET(self):
+                url = urlparse(self.path)
+                try:
+                    with METRICS.timer('service_request_seconds'):
+                        content_type, body, etag = service.respond(url.path, parse_qs(url.query))
+                except KeyError as error:
+                    status = 404 if error.args and error.args[0] == url.path else 400
+                    self.send_error(status)
+                    return
+                except ValueError as error:
+                    self.send_error(400, str(error))
+                    return
+                except Exception as error:
+                    METRICS.increment('service_errors', error=type(error).__name__)
+                    self.send_error(500, type(error).__name__)
+                    return
+                if etag and self.headers.get('If-None-Match') == etag:
+                    self.send_response(304)
+                    self.send_header('ETag', etag)
+                    self.send_header('Content-Length', '0')
+                    self.end_headers()
+                    return
+                self.send_response(200)
+                self.send_header('Content-Type', content_type)
+                self.send_header('Content-Length', str(len(body)))
+                if etag:
+                    self.send_header('ETag', etag)
+                self.end_headers()
+                self.wfile.write(body)
+
+            def log_message(self, format, *args):
+                return
+
+        return Handler
+
+
+if __name__ == "__main__":
+    PARSER = argparse.ArgumentParser(description='serve the weather plots and daily series over HTTP')
+    PARSER.add_argument('--db', default='weather.sqlite')
+    PARSER.add_argument('--table', default='weather')
+    PARSER.add_argument('--host', default='127.0.0.1')
+    PARSER.add_argument('--port', type=int, default=8000)
+    PARSER.add_argument('--export-dir', help="read the daily series from this columnar export")
+    PARSER.add_argument('--pool-size', type=int, default=4)
+    ARGS = PARSER.parse_args()
+    SERVICE = WeatherService(ARGS.db, ARGS.table, ARGS.host, ARGS.port, ARGS.export_dir, ARGS.pool_size)
+    print('serving on', SERVICE.base_url)
+    try:
+        SERVICE.httpd.serve_forever()
+    except KeyboardInterrupt:
+        SERVICE.httpd.server_close()